@@ -11,10 +11,15 @@ import jsonrpc
 
 class BitcoindConnection(object):
     def __init__(self, connection_string, main_account_name):
-        self.bitcoind_api = jsonrpc.ServiceProxy(connection_string)
+        self.bitcoind_api = jsonrpc.ServiceProxy(
+            connection_string,
+            timeout=settings.BITCOIND_RPC_TIMEOUT,
+            pool_size=settings.BITCOIND_CONNECTION_POOL_SIZE)
         self.account_name = main_account_name
 
     def total_received(self, address, minconf=settings.BITCOIN_MINIMUM_CONFIRMATIONS):
+        if isinstance(address, (list, tuple, set)):
+            return self.total_received_many(address, minconf=minconf)
         if settings.BITCOIN_TRANSACTION_CACHING:
             cache_key = address + "_" + str(minconf)
             cached = cache.get(cache_key)
@@ -28,6 +33,35 @@ class BitcoindConnection(object):
             self.bitcoind_api.getreceivedbyaddress(address, minconf)
         )
 
+    def total_received_many(self, addresses, minconf=settings.BITCOIN_MINIMUM_CONFIRMATIONS):
+        """Returns a dict address -> total received, querying bitcoind in
+        batches of BITCOIND_BATCH_SIZE calls per HTTP round trip.
+        """
+        addresses = list(addresses)
+        received = {}
+        if settings.BITCOIN_TRANSACTION_CACHING:
+            cache_keys = dict((address + "_" + str(minconf), address) for address in addresses)
+            for cache_key, cached in cache.get_many(cache_keys.keys()).items():
+                if cached is not None:
+                    received[cache_keys[cache_key]] = cached
+            addresses = [a for a in addresses if a not in received]
+
+        fetched = {}
+        for i in range(0, len(addresses), settings.BITCOIND_BATCH_SIZE):
+            chunk = addresses[i:i + settings.BITCOIND_BATCH_SIZE]
+            results = self.bitcoind_api.batch_(
+                [["getreceivedbyaddress", address, minconf] for address in chunk])
+            for address, result in zip(chunk, results):
+                if isinstance(result, jsonrpc.JSONRPCException):
+                    raise result
+                fetched[address] = decimal.Decimal(result)
+
+        if settings.BITCOIN_TRANSACTION_CACHING and fetched:
+            cache.set_many(dict((address + "_" + str(minconf), amount)
+                                for address, amount in fetched.items()), 5)
+        received.update(fetched)
+        return received
+
     def send(self, address, amount, *args, **kwargs):
         #print "sending", address, amount
         return self.bitcoind_api.sendtoaddress(address, float(amount), *args, **kwargs)
@@ -40,6 +74,20 @@ class BitcoindConnection(object):
         return self.bitcoind_api.getnewaddress(
             for_account or self.account_name, *args, **kwargs)
 
+    def create_addresses(self, count, for_account=None):
+        """Returns ``count`` new addresses, fetched with batched
+        getnewaddress calls."""
+        addresses = []
+        while len(addresses) < count:
+            chunk = min(count - len(addresses), settings.BITCOIND_BATCH_SIZE)
+            results = self.bitcoind_api.batch_(
+                [["getnewaddress", for_account or self.account_name]] * chunk)
+            for result in results:
+                if isinstance(result, jsonrpc.JSONRPCException):
+                    raise result
+                addresses.append(result)
+        return addresses
+
     def gettransaction(self, txid, *args, **kwargs):
         # dir (self.bitcoind_api)
         return self.bitcoind_api.gettransaction(txid, *args, **kwargs)
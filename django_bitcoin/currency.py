@@ -23,6 +23,8 @@ from django.core.cache import cache
 
 import json
 import sys
+import threading
+import time
 import urllib2
 from decimal import Decimal
 
@@ -59,6 +61,92 @@ class TemporaryConversionError(ConversionError):
     pass
 
 
+WEIGHTED_PRICES_URL = u"http://api.bitcoincharts.com/v1/weighted_prices.json"
+
+MARKETS_URL = u"http://api.bitcoincharts.com/v1/markets.json"
+
+OLD_VALUE_SECONDS = 60 * 60 * 24 * 7
+
+
+def fetch_json(url):
+    f = urllib2.urlopen(url, timeout=settings.BITCOIN_RATE_FETCH_TIMEOUT)
+    return json.loads(f.read())
+
+
+def refresh_cached(cache_key, cache_key_old, fetch, timeout):
+    """Fetches a fresh value into the cache. Returns None on failure, in
+    which case the old value is served for another ``timeout`` seconds."""
+    try:
+        try:
+            value = fetch()
+        except Exception, err:
+            print "Unexpected error:", sys.exc_info()[0], err
+            old = cache.get(cache_key_old)
+            if old:
+                cache.set(cache_key, old, timeout)
+            return None
+        cache.set(cache_key, value, timeout)
+        cache.set(cache_key_old, value, OLD_VALUE_SECONDS)
+        return value
+    finally:
+        cache.delete(cache_key + "_refreshing")
+
+
+REFRESH_POLL_SECONDS = 0.05
+
+
+def wait_for_refresh(cache_key, seconds):
+    """Waits up to ``seconds`` for the worker refreshing ``cache_key``,
+    returns the new value or None."""
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        time.sleep(REFRESH_POLL_SECONDS)
+        value = cache.get(cache_key)
+        if value:
+            return value
+        if not cache.get(cache_key + "_refreshing"):
+            return cache.get(cache_key)
+    return None
+
+
+def cached_upstream(cache_key, fetch, timeout, error, cache_key_old=None, force=False):
+    """
+    Returns the cached value of an external data source, fetching it with
+    ``fetch`` when it has expired.
+
+    Only the worker that wins the ``<cache_key>_refreshing`` flag fetches.
+    With BITCOIN_RATE_BACKGROUND_REFRESH it does so in a background thread,
+    and meanwhile everyone is served the old value. When there is no old
+    value at all (cold start, flushed cache) the others wait for that
+    fetch. ``error`` is raised when there's nothing to serve, also to the
+    waiters if the fetch doesn't arrive in time.
+    """
+    if cache_key_old is None:
+        cache_key_old = cache_key + "_old"
+    if not force:
+        value = cache.get(cache_key)
+        if value:
+            return value
+    old = cache.get(cache_key_old)
+    if cache.add(cache_key + "_refreshing", True, settings.BITCOIN_RATE_FETCH_TIMEOUT * 2):
+        if old and settings.BITCOIN_RATE_BACKGROUND_REFRESH:
+            thread = threading.Thread(target=refresh_cached,
+                                      args=(cache_key, cache_key_old, fetch, timeout))
+            thread.daemon = True
+            thread.start()
+            return old
+        value = refresh_cached(cache_key, cache_key_old, fetch, timeout)
+        if value:
+            return value
+    elif not old:
+        value = wait_for_refresh(cache_key, settings.BITCOIN_RATE_FETCH_TIMEOUT)
+        if value:
+            return value
+    if not old:
+        raise error
+    return old
+
+
 class Exchange(object):
     def __init__(self):
         self.currencies = {}
@@ -158,35 +246,31 @@ class BitcoinChartsCurrency(Currency):
     def __init__(self):
         self.cache_key = "%s_in_btc" % self.identifier
         self.cache_key_old = "%s_was_in_btc" % self.identifier
+        # (factor, expires at) kept in this process in front of the cache
+        self.local_factor = None
 
-    def populate_cache(self):
-        try:
-            f = urllib2.urlopen(
-                u"http://api.bitcoincharts.com/v1/weighted_prices.json")
-            result = f.read()
-            j = json.loads(result)
-            base_price = j[self.identifier]
-            cache.set(self.cache_key, base_price, 60 * 60)
-            #print result
-        except:
-            print "Unexpected error:", sys.exc_info()[0]
+    def fetch(self):
+        return fetch_json(WEIGHTED_PRICES_URL)[self.identifier]
 
-        if not cache.get(self.cache_key):
-            if not cache.get(self.cache_key_old):
-                raise TemporaryConversionError(
-                    "Cache not enabled, reliable exchange rate is not available for %s" % self.identifier)
-            cache.set(self.cache_key, cache.get(self.cache_key_old), 60 * 60)
+    def get_prices(self, force=False):
+        return cached_upstream(
+            self.cache_key, self.fetch, 60 * 60,
+            TemporaryConversionError(
+                "Cache not enabled, reliable exchange rate is not available for %s" % self.identifier),
+            cache_key_old=self.cache_key_old, force=force)
 
-        cache.set(self.cache_key_old, cache.get(self.cache_key), 60 * 60 * 24 * 7)
+    def populate_cache(self):
+        self.local_factor = None
+        self.get_prices(force=True)
 
     def get_factor(self):
-        cached = cache.get(self.cache_key)
-        if cached:
-            factor = cached[self.period]
-        else:
-            self.populate_cache()
-            factor = cache.get(self.cache_key)[self.period]
-        return decimal.Decimal(factor)
+        local_factor = self.local_factor
+        if local_factor is not None and local_factor[1] > time.time():
+            return local_factor[0]
+        factor = decimal.Decimal(self.get_prices()[self.period])
+        if settings.BITCOIN_RATE_LOCAL_CACHE_SECONDS:
+            self.local_factor = (factor, time.time() + settings.BITCOIN_RATE_LOCAL_CACHE_SECONDS)
+        return factor
 
     def to_btc(self, amount):
         return amount * self.get_factor()
@@ -208,88 +292,36 @@ exchange = Exchange()
 # simple utility functions for conversions
 
 
-def markets_chart():
-    cache_key = "bitcoincharts_markets"
-    cache_key_old = "bitcoincharts_markets_old"
-    if not cache.get(cache_key):
-        try:
-            f = urllib2.urlopen(
-                u"http://api.bitcoincharts.com/v1/markets.json")
-            result = f.read()
-            j = json.loads(result)
-            final_markets = {}
-            for market in j:
-                b = True
-                for mp in MARKET_PARAMETERS:
-                    if not market[mp]:
-                        b = False
-                        break
-                if b:
-                    # print market['symbol']
-                    final_markets[market['symbol'].lower()] = market
-            cache.set(cache_key, final_markets, 60 * 5)
-            #print result
-        except Exception, err:
-            print "Unexpected error:", sys.exc_info()[0], err
+def fetch_markets():
+    final_markets = {}
+    for market in fetch_json(MARKETS_URL):
+        b = True
+        for mp in MARKET_PARAMETERS:
+            if not market[mp]:
+                b = False
+                break
+        if b:
+            # print market['symbol']
+            final_markets[market['symbol'].lower()] = market
+    return final_markets
 
-        if not cache.get(cache_key):
-            if not cache.get(cache_key_old):
-                raise Exception(
-                    "Cache not enabled, reliable market data is not available")
-            cache.set(cache_key, cache.get(cache_key_old), 60 * 5)
 
-        cache.set(cache_key_old, cache.get(cache_key), 60 * 60 * 24 * 7)
-    return cache.get(cache_key)
+def markets_chart():
+    return cached_upstream(
+        "bitcoincharts_markets", fetch_markets, 60 * 5,
+        Exception("Cache not enabled, reliable market data is not available"))
 
 
 def get_rate_table():
-    cache_key = "bitcoincharts_all"
-    cache_key_old = "bitcoincharts_all_old"
-    if not cache.get(cache_key):
-        try:
-            f = urllib2.urlopen(
-                u"http://api.bitcoincharts.com/v1/weighted_prices.json")
-            result = f.read()
-            j = json.loads(result)
-            cache.set(cache_key, j, 60 * 60)
-            print result
-        # except ValueError:
-
-        except:
-            print "Unexpected error:", sys.exc_info()[0]
-
-        if not cache.get(cache_key):
-            if not cache.get(cache_key_old):
-                raise TemporaryConversionError(
-                    "Cache not enabled, reliable exchange rate is not available")
-            cache.set(cache_key, cache.get(cache_key_old), 60 * 60)
-
-        cache.set(cache_key_old, cache.get(cache_key), 60 * 60 * 24 * 7)
-    return cache.get(cache_key)
+    return cached_upstream(
+        "bitcoincharts_all", lambda: fetch_json(WEIGHTED_PRICES_URL), 60 * 60,
+        TemporaryConversionError("Cache not enabled, reliable exchange rate is not available"))
 
 
 def currency_exchange_rates():
-    cache_key = "currency_exchange_rates"
-    cache_key_old = "currency_exchange_rates_old"
-    if not cache.get(cache_key):
-        try:
-            f = urllib2.urlopen(
-                settings.BITCOIN_OPENEXCHANGERATES_URL)
-            result = f.read()
-            j = json.loads(result)
-            cache.set(cache_key, j, 60 * 5)
-            #print result
-        except Exception, err:
-            print "Unexpected error:", sys.exc_info()[0], err
-
-        if not cache.get(cache_key):
-            if not cache.get(cache_key_old):
-                raise Exception(
-                    "Cache not enabled, reliable market data is not available")
-            cache.set(cache_key, cache.get(cache_key_old), 60 * 60 * 2)
-
-        cache.set(cache_key_old, cache.get(cache_key), 60 * 60 * 24 * 7)
-    return cache.get(cache_key)
+    return cached_upstream(
+        "currency_exchange_rates", lambda: fetch_json(settings.BITCOIN_OPENEXCHANGERATES_URL), 60 * 5,
+        Exception("Cache not enabled, reliable market data is not available"))
 
 
 def currency_list():
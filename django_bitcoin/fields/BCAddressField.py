@@ -5,7 +5,7 @@
 from django.forms.util import ValidationError
 from django import forms
 from . import utils
-import re
+from .. import settings
 
 
 class BCAddressField(forms.CharField):
@@ -20,8 +20,6 @@ class BCAddressField(forms.CharField):
         if not value and not self.required:
             return None
 
-        if not value.startswith(u"1") and not value.startswith(u"3"):
-            raise ValidationError(self.error_messages['invalid'])
         value = value.strip()
 
         if "\n" in value:
@@ -30,10 +28,28 @@ class BCAddressField(forms.CharField):
         if " " in value:
             raise ValidationError(u"Spaces in the bitcoin address")
 
-        if re.match(r"[a-zA-Z1-9]{27,35}$", value) is None:
-            raise ValidationError(self.error_messages['invalid'])
-        version = utils.get_bcaddress_version(value)
-        if version is None:
+        parsed = utils.parse_address(value, settings.BITCOIN_NETWORK)
+        if parsed is None:
             raise ValidationError(self.error_messages['invalid'])
+        if parsed.kind == 'witness':
+            # bech32 is case insensitive, store one spelling
+            value = value.lower()
         return value
 
+
+class BCAddressListField(forms.CharField):
+    """One bitcoin address per line, cleans to a list of addresses."""
+    widget = forms.Textarea
+
+    def clean(self, value):
+        value = super(BCAddressListField, self).clean(value)
+        if not value:
+            return []
+        checks = utils.validate_addresses(value.splitlines(), network=settings.BITCOIN_NETWORK)
+        checks = [check for check in checks if check.address]
+        errors = [u"Line %d: %s %s" % (check.line, check.error, check.address)
+                  for check in checks if check.error]
+        if errors:
+            raise ValidationError(errors)
+        return [check.address.lower() if check.parsed.kind == 'witness' else check.address
+                for check in checks]
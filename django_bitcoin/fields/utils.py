@@ -1,57 +1,54 @@
+import binascii
 import hashlib
-import re
+import itertools
+import multiprocessing
+import threading
+
+from collections import OrderedDict, deque, namedtuple
 
 __b58chars = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
 __b58base = len(__b58chars)
 
+# character code -> digit value, -1 for characters outside the alphabet
+__b58values = [-1] * 256
+for (i, c) in enumerate(__b58chars):
+    __b58values[ord(c)] = i
+
 
 def b58encode(v):
     """ encode v, which is a string of bytes, to base58.
     """
+    long_value = int(binascii.hexlify(v), 16) if v else 0
 
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += (256 ** i) * ord(c)
-
-    result = ''
+    digits = []
     while long_value >= __b58base:
-        div, mod = divmod(long_value, __b58base)
-        result = __b58chars[mod] + result
-        long_value = div
-    result = __b58chars[long_value] + result
+        long_value, mod = divmod(long_value, __b58base)
+        digits.append(__b58chars[mod])
+    digits.append(__b58chars[long_value])
+    result = ''.join(reversed(digits))
 
     # Bitcoin does a little leading-zero-compression:
     # leading 0-bytes in the input become leading-1s
-    nPad = 0
-    for c in v:
-        if c == '\0':
-            nPad += 1
-        else:
-            break
+    nPad = len(v) - len(v.lstrip('\0'))
 
     return (__b58chars[0] * nPad) + result
 
 
 def b58decode(v, length):
-    """ decode v into a string of len bytes
+    """ decode v into a string of len bytes, None if v has characters
+    outside the base58 alphabet or decodes to another length
     """
-    long_value = 0L
-    for (i, c) in enumerate(v[::-1]):
-        long_value += __b58chars.find(c) * (__b58base ** i)
-
-    result = ''
-    while long_value >= 256:
-        div, mod = divmod(long_value, 256)
-        result = chr(mod) + result
-        long_value = div
-    result = chr(long_value) + result
-
-    nPad = 0
+    long_value = 0
     for c in v:
-        if c == __b58chars[0]:
-            nPad += 1
-        else:
-            break
+        digit = __b58values[ord(c)] if ord(c) < 256 else -1
+        if digit < 0:
+            return None
+        long_value = long_value * __b58base + digit
+
+    result = '%x' % long_value
+    result = binascii.unhexlify('0' * (len(result) % 2) + result)
+
+    nPad = len(v) - len(v.lstrip(__b58chars[0]))
 
     result = chr(0) * nPad + result
     if length is not None and len(result) != length:
@@ -85,14 +82,194 @@ def b36decode(number):
     return int(number, 36)
 
 
-def is_valid_btc_address(value):
-    value = value.strip()
-    if re.match(r"[a-zA-Z1-9]{27,35}$", value) is None:
-        return False
-    version = get_bcaddress_version(value)
-    if version is None:
-        return False
-    return True
+class LRUCache(object):
+    """A thread safe dict of at most ``size`` items, dropping the least
+    recently used ones."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.items.pop(key)
+            except KeyError:
+                return default
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+
+# Version bytes of the base58 addresses we can pay to
+ADDRESS_VERSIONS = {
+    0: ('p2pkh', 'mainnet'),
+    5: ('p2sh', 'mainnet'),
+    111: ('p2pkh', 'testnet'),
+    196: ('p2sh', 'testnet'),
+}
+
+# Human readable parts of segwit addresses
+BECH32_NETWORKS = {
+    'bc': 'mainnet',
+    'tb': 'testnet',
+    'bcrt': 'regtest',
+}
+
+__bech32chars = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+__bech32values = [-1] * 256
+for (i, c) in enumerate(__bech32chars):
+    __bech32values[ord(c)] = i
+__bech32generator = (0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3)
+# checksum constants of bech32 (witness version 0) and bech32m (1 to 16)
+BECH32_CONST = 1
+BECH32M_CONST = 0x2bc830a3
+
+BAD_CHARSET = 'bad charset'
+BAD_LENGTH = 'bad length'
+BAD_CHECKSUM = 'bad checksum'
+UNKNOWN_VERSION = 'unknown version'
+WRONG_NETWORK = 'wrong network'
+
+# kind is 'p2pkh', 'p2sh' or 'witness'. version is the version byte of
+# base58 addresses and the witness version of segwit ones, program is the
+# hash160 or the witness program.
+ParsedAddress = namedtuple('ParsedAddress', 'kind network version program')
+
+
+def _bech32_step(checksum, value):
+    top = checksum >> 25
+    checksum = (checksum & 0x1ffffff) << 5 ^ value
+    for i in range(5):
+        if (top >> i) & 1:
+            checksum ^= __bech32generator[i]
+    return checksum
+
+
+def _parse_segwit(value, separator):
+    if not 14 <= len(value) <= 90:
+        return None, BAD_LENGTH
+    if value.lower() != value and value.upper() != value:
+        return None, BAD_CHARSET
+    value = value.lower()
+    hrp = value[:separator]
+    checksum = 1
+    for c in hrp:
+        checksum = _bech32_step(checksum, ord(c) >> 5)
+    checksum = _bech32_step(checksum, 0)
+    for c in hrp:
+        checksum = _bech32_step(checksum, ord(c) & 31)
+    # one scan maps the characters, checksums them and regroups the
+    # 5 bit values of the witness program into bytes
+    data = value[separator + 1:]
+    if len(data) < 7:
+        return None, BAD_LENGTH
+    program = []
+    acc = bits = 0
+    for (i, c) in enumerate(data):
+        digit = __bech32values[ord(c)] if ord(c) < 256 else -1
+        if digit < 0:
+            return None, BAD_CHARSET
+        checksum = _bech32_step(checksum, digit)
+        if 0 < i < len(data) - 6:
+            acc = (acc << 5 | digit) & 0xfff
+            bits += 5
+            if bits >= 8:
+                bits -= 8
+                program.append(chr(acc >> bits & 0xff))
+    version = __bech32values[ord(data[0])]
+    if version > 16:
+        return None, UNKNOWN_VERSION
+    if checksum != (BECH32_CONST if version == 0 else BECH32M_CONST):
+        return None, BAD_CHECKSUM
+    if bits >= 5 or acc & ((1 << bits) - 1):
+        return None, BAD_LENGTH
+    if not 2 <= len(program) <= 40 or (version == 0 and len(program) not in (20, 32)):
+        return None, BAD_LENGTH
+    return ParsedAddress('witness', BECH32_NETWORKS[hrp], version, ''.join(program)), None
+
+
+def _parse_base58(value):
+    if not 25 <= len(value) <= 35:
+        for c in value:
+            if ord(c) >= 256 or __b58values[ord(c)] < 0:
+                return None, BAD_CHARSET
+        return None, BAD_LENGTH
+    long_value = 0
+    for c in value:
+        digit = __b58values[ord(c)] if ord(c) < 256 else -1
+        if digit < 0:
+            return None, BAD_CHARSET
+        long_value = long_value * __b58base + digit
+    nPad = len(value) - len(value.lstrip(__b58chars[0]))
+    addr = '%x' % long_value
+    addr = chr(0) * nPad + binascii.unhexlify('0' * (len(addr) % 2) + addr)
+    if len(addr) != 25:
+        return None, BAD_LENGTH
+    h3 = hashlib.sha256(hashlib.sha256(addr[:-4]).digest()).digest()
+    if h3[0:4] != addr[-4:]:
+        return None, BAD_CHECKSUM
+    version = ord(addr[0])
+    if version not in ADDRESS_VERSIONS:
+        return None, UNKNOWN_VERSION
+    kind, network = ADDRESS_VERSIONS[version]
+    return ParsedAddress(kind, network, version, addr[1:21]), None
+
+
+def _parse(value):
+    separator = value.rfind('1')
+    if separator > 0 and value[:separator].lower() in BECH32_NETWORKS:
+        return _parse_segwit(value, separator)
+    return _parse_base58(value)
+
+
+def on_network(parsed, network):
+    """ True if the parsed address can be paid on ``network`` ('mainnet',
+    'testnet' or 'regtest'). Regtest uses the testnet version bytes for
+    base58 addresses. """
+    if parsed.network == network:
+        return True
+    return network == 'regtest' and parsed.kind != 'witness' and parsed.network == 'testnet'
+
+
+def check_address(value, network=None):
+    """ Parses a base58 (p2pkh, p2sh) or bech32/bech32m (segwit) address.
+    Returns (ParsedAddress, None) for a valid address, otherwise
+    (None, reason) with one of the error reasons above. With ``network``
+    addresses of other networks are rejected with WRONG_NETWORK. """
+    parsed, error = _parse(value)
+    if parsed is not None and network is not None and not on_network(parsed, network):
+        return None, WRONG_NETWORK
+    return parsed, error
+
+
+# Address validation results, the same payout addresses come up repeatedly
+ADDRESS_CACHE_SIZE = 10000
+_parsed_addresses = LRUCache(ADDRESS_CACHE_SIZE)
+
+
+def parse_address(value, network=None):
+    """ Returns a ParsedAddress, or None if value is not a valid address
+    (of ``network``, if given). """
+    parsed = _parsed_addresses.get(value)
+    if parsed is None:
+        parsed = _parse(value)
+        _parsed_addresses.set(value, parsed)
+    parsed = parsed[0]
+    if parsed is not None and network is not None and not on_network(parsed, network):
+        return None
+    return parsed
+
+
+def is_valid_btc_address(value, network=None):
+    return parse_address(value.strip(), network) is not None
 
 
 def get_bcaddress_version(strAddress):
@@ -108,3 +285,52 @@ def get_bcaddress_version(strAddress):
         return ord(version)
     return None
 
+
+AddressCheck = namedtuple('AddressCheck', 'line address parsed error')
+
+
+def imap_bounded(pool, func, iterable, window):
+    """Like ``pool.imap``, but reads ``iterable`` at most ``window`` items
+    ahead of the results that were consumed."""
+    iterable = iter(iterable)
+    pending = deque(pool.apply_async(func, (item,)) for item in itertools.islice(iterable, window))
+    while pending:
+        result = pending.popleft().get()
+        for item in itertools.islice(iterable, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield result
+
+
+def _check_lines(args):
+    numbered_lines, network = args
+    return [AddressCheck(line, address, *check_address(address, network))
+            for line, address in numbered_lines]
+
+
+def validate_addresses(lines, processes=None, chunk_size=1000, network=None):
+    """
+    Checks an iterable of addresses, e.g. the lines of a payout file, and
+    yields an AddressCheck(line, address, parsed, error) for each one in
+    input order. ``error`` is None for valid addresses. With ``network``
+    addresses of other networks fail with WRONG_NETWORK.
+
+    The input is consumed lazily in chunks of ``chunk_size``. With
+    ``processes`` the chunks are checked in a process pool, with at most
+    two chunks per process read ahead.
+    """
+    numbered = ((line, address.strip()) for line, address in enumerate(lines, 1))
+    chunks = iter(lambda: list(itertools.islice(numbered, chunk_size)), [])
+    chunks = ((chunk, network) for chunk in chunks)
+    if not processes or processes <= 1:
+        for chunk in chunks:
+            for result in _check_lines(chunk):
+                yield result
+        return
+    pool = multiprocessing.Pool(processes)
+    try:
+        for results in imap_bounded(pool, _check_lines, chunks, 2 * processes):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
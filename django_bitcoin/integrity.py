@@ -0,0 +1,131 @@
+# vim: tabstop=4 expandtab autoindent shiftwidth=4 fileencoding=utf-8
+"""Database integrity checks for wallets, addresses and deposits.
+
+Everything is computed from a handful of grouped aggregate queries which
+are joined in memory, so the run time doesn't depend on the number of
+queries the database can answer per second.
+"""
+
+from django.db.models import Sum
+
+from decimal import Decimal
+
+from . import settings
+
+
+def _sums(queryset, key, field='amount'):
+    """Returns {key value: sum of field} from one GROUP BY query."""
+    rows = queryset.order_by().values(key).annotate(total=Sum(field))
+    return dict((row[key], row['total'] or Decimal(0)) for row in rows)
+
+
+def _sum(queryset, field='amount'):
+    return queryset.aggregate(total=Sum(field))['total'] or Decimal(0)
+
+
+def check_integrity(bitcoind=None):
+    """
+    Returns a report dict with the totals and one list per kind of
+    mismatch:
+
+    ``wallets``: (wallet id, last_balance, balance_confirmed, computed),
+    for ledger balances that differ from the computed one and for
+    non-zero last_balance values that do
+    ``deposits``: (address, least_received, deposit sum)
+    ``addresses``: (address, confirmed deposit sum, deposit transaction
+    sum, least_received_confirmed)
+    ``errors``: messages for global inconsistencies
+    """
+    # Circularity and locality
+    from . import models
+
+    report = {'totals': {}, 'wallets': [], 'deposits': [], 'addresses': [], 'errors': []}
+    totals = report['totals']
+
+    transactions = models.WalletTransaction.objects.all()
+    addresses = models.BitcoinAddress.objects.all()
+
+    totals['received'] = _sum(addresses.filter(active=True), 'least_received_confirmed')
+    totals['transactions'] = _sum(transactions.filter(from_wallet__id__gt=0, to_wallet__id__gt=0))
+    totals['outgoing'] = _sum(transactions.filter(from_wallet__id__gt=0).exclude(to_bitcoinaddress=""))
+    totals['fees'] = _sum(transactions.filter(from_wallet__id__gt=0, to_wallet__isnull=True, to_bitcoinaddress=""))
+    totals['db_balance'] = totals['received'] - totals['outgoing'] - totals['fees']
+    if bitcoind is not None:
+        totals['bitcoind_balance'] = bitcoind.bitcoind_api.getbalance()
+
+    totals['deposits_migrated'] = _sum(transactions.filter(from_wallet=None))
+    migrated_received = _sum(addresses.filter(migrated_to_transactions=True), 'least_received_confirmed')
+    totals['deposits_unmigrated'] = _sum(addresses.filter(migrated_to_transactions=False), 'least_received_confirmed')
+    if totals['deposits_migrated'] != migrated_received:
+        report['errors'].append("wrong total receive amount! %s, %s" % (totals['deposits_migrated'], migrated_received))
+    if models.DepositTransaction.objects.filter(address__migrated_to_transactions=False).exclude(transaction=None).exists():
+        report['errors'].append("Illegal transaction!")
+    if transactions.filter(from_wallet=None, deposit_address=None).exists():
+        report['errors'].append("Illegal deposit transactions!")
+
+    # Wallets: unmigrated address deposits + received - sent
+    unmigrated = _sums(addresses.filter(migrated_to_transactions=False, wallet__isnull=False),
+                       'wallet', 'least_received_confirmed')
+    received = _sums(transactions.filter(to_wallet__isnull=False), 'to_wallet')
+    sent = _sums(transactions.filter(from_wallet__isnull=False), 'from_wallet')
+    totals['negative_wallets'] = 0
+    totals['negative_amount'] = Decimal(0)
+    for wallet_id, last_balance, balance_confirmed in models.Wallet.objects.order_by()\
+            .values_list('id', 'last_balance', 'balance_confirmed').iterator():
+        computed = unmigrated.get(wallet_id, 0) + received.get(wallet_id, 0) - sent.get(wallet_id, 0)
+        if computed < 0:
+            totals['negative_wallets'] += 1
+            totals['negative_amount'] += computed
+        # last_balance is a lazily refreshed cache, the default 0 of an
+        # untouched wallet isn't an error
+        if balance_confirmed != computed or (last_balance > 0 and last_balance != computed):
+            report['wallets'].append((wallet_id, last_balance, balance_confirmed, computed))
+
+    # Addresses: deposits against the address counters
+    deposits = models.DepositTransaction.objects.all()
+    deposit_sums = {}
+    for row in deposits.order_by().values('address', 'wallet').annotate(total=Sum('amount')):
+        deposit_sums[(row['address'], row['wallet'])] = row['total'] or Decimal(0)
+    confirmed_sums = _sums(deposits.filter(confirmations__gte=settings.BITCOIN_MINIMUM_CONFIRMATIONS), 'address')
+    wt_sums = _sums(transactions.filter(deposit_address__isnull=False), 'deposit_address')
+    for address_id, address, wallet_id, least_received, least_received_confirmed in addresses\
+            .filter(migrated_to_transactions=True).order_by()\
+            .values_list('id', 'address', 'wallet', 'least_received', 'least_received_confirmed').iterator():
+        if least_received_confirmed > 0:
+            s = deposit_sums.get((address_id, wallet_id), Decimal(0))
+            if s != least_received:
+                report['deposits'].append((address, least_received, s))
+        deposit_sum = confirmed_sums.get(address_id, Decimal(0))
+        wt_sum = wt_sums.get(address_id, Decimal(0))
+        if wt_sum != deposit_sum or least_received_confirmed != deposit_sum:
+            report['addresses'].append((address, deposit_sum, wt_sum, least_received_confirmed))
+
+    return report
+
+
+def format_integrity_report(report):
+    totals = report['totals']
+    lines = [
+        "Total received, sum %s" % totals['received'],
+        "Total transactions, sum %s" % totals['transactions'],
+        "Total outgoing, sum %s" % totals['outgoing'],
+        "Fees, sum %s" % totals['fees'],
+        "DB balance %s" % totals['db_balance'],
+        "----",
+    ]
+    if 'bitcoind_balance' in totals:
+        lines += ["Bitcoind balance %s" % totals['bitcoind_balance'], "----"]
+    lines.append("Negatives: %s Amount: %s" % (totals['negative_wallets'], totals['negative_amount']))
+    lines.append("Total %s BTC deposits migrated, unmigrated %s BTC" % (totals['deposits_migrated'],
+                                                                         totals['deposits_unmigrated']))
+    lines += report['errors']
+    lines.append("Wallet check: %d errors" % len(report['wallets']))
+    for row in report['wallets']:
+        lines.append("Wallet balance error! %s last_balance %s ledger %s computed %s" % row)
+    lines.append("Address check: %d errors" % len(report['deposits']))
+    for row in report['deposits']:
+        lines.append("DepositTransaction error %s %s %s" % row)
+    lines.append("BitcoinAddress check: %d errors" % len(report['addresses']))
+    for row in report['addresses']:
+        lines.append("Bitcoinaddress integrity error! %s %s %s %s" % row)
+    return "\n".join(lines)
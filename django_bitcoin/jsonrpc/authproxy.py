@@ -5,7 +5,8 @@
   AuthServiceProxy has the following improvements over python-jsonrpc's
   ServiceProxy class:
 
-  - HTTP connections persist for the life of the AuthServiceProxy object
+  - HTTP connections are kept alive in a thread-safe pool shared by the
+    AuthServiceProxy object and the method proxies created from it
     (if server supports HTTP/1.1)
   - sends protocol 'version', per JSON-RPC 1.1
   - sends proper, incrementing 'id'
@@ -38,62 +39,137 @@ import httplib
 import base64
 import json
 import decimal
+import itertools
+import select
+import socket
 import urlparse
+import Queue
 
 USER_AGENT = "AuthServiceProxy/0.1"
 
 HTTP_TIMEOUT = 30
 
+POOL_SIZE = 10
+
+_id_counter = itertools.count(1)
+
 class JSONRPCException(Exception):
     def __init__(self, rpcError):
         Exception.__init__(self)
         self.error = rpcError
 
+class HTTPConnectionPool(object):
+    """Thread-safe pool of keep-alive connections to one JSON-RPC server.
+
+    At most ``size`` connections are checked out at once; further callers
+    wait for a free one. Idle connections are reused most recently used
+    first, so rarely needed sockets time out on the server side instead of
+    the hot ones.
+    """
+
+    def __init__(self, url, size=POOL_SIZE, timeout=HTTP_TIMEOUT):
+        self.url = url
+        self.size = size
+        self.timeout = timeout
+        if url.port is None:
+            self.port = 80
+        else:
+            self.port = url.port
+        # A slot is either an idle connection or None for "not connected".
+        self.__slots = Queue.LifoQueue(size)
+        for i in range(size):
+            self.__slots.put(None)
+
+    def new_connection(self, timeout):
+        if self.url.scheme == 'https':
+            return httplib.HTTPSConnection(self.url.hostname, self.port, None, None, False,
+                    timeout)
+        return httplib.HTTPConnection(self.url.hostname, self.port, False,
+                timeout)
+
+    def get(self, timeout):
+        """Returns a (connection, reused) pair, waiting at most ``timeout``
+        seconds for a free slot."""
+        try:
+            conn = self.__slots.get(True, timeout)
+        except Queue.Empty:
+            raise JSONRPCException({
+                'code' : -344, 'message' : 'no free connection in the pool'})
+        if conn is None or self.is_stale(conn):
+            if conn is not None:
+                conn.close()
+            return (self.new_connection(timeout), False)
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return (conn, True)
+
+    def is_stale(self, conn):
+        """An idle keep-alive socket has nothing to read, so a readable one
+        was closed by the server (or holds garbage) and must not be used."""
+        if conn.sock is None:
+            return False
+        try:
+            readable, writable, failed = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+        return bool(readable)
+
+    def put(self, conn):
+        self.__slots.put(conn)
+
+    def discard(self, conn):
+        conn.close()
+        self.__slots.put(None)
+
+    def close(self):
+        """Closes all idle connections. Checked out ones are left alone."""
+        idle = []
+        while True:
+            try:
+                idle.append(self.__slots.get_nowait())
+            except Queue.Empty:
+                break
+        for conn in idle:
+            if conn is not None:
+                conn.close()
+            self.__slots.put(None)
+
 class AuthServiceProxy(object):
-    def __init__(self, serviceURL, serviceName=None):
+    def __init__(self, serviceURL, serviceName=None, timeout=None,
+                 pool_size=POOL_SIZE, pool=None):
         self.__serviceURL = serviceURL
         self.__serviceName = serviceName
         self.__url = urlparse.urlparse(serviceURL)
-        if self.__url.port is None:
-            port = 80
-        else:
-            port = self.__url.port
-        self.__idcnt = 0
         authpair = "%s:%s" % (self.__url.username, self.__url.password)
         self.__authhdr = "Basic %s" % (base64.b64encode(authpair))
-        if self.__url.scheme == 'https':
-            self.__conn = httplib.HTTPSConnection(self.__url.hostname, port, None, None,False,
-                    HTTP_TIMEOUT)
-        else:
-            self.__conn = httplib.HTTPConnection(self.__url.hostname, port, False,
-                    HTTP_TIMEOUT)
+        if pool is None:
+            pool = HTTPConnectionPool(self.__url, pool_size, timeout or HTTP_TIMEOUT)
+        self.__pool = pool
+        self.__timeout = timeout or pool.timeout
 
     def __getattr__(self, name):
+        if name.startswith('__') and name.endswith('__'):
+            # Python internals (copy, pickle) are not RPC methods
+            raise AttributeError(name)
         if self.__serviceName != None:
             name = "%s.%s" % (self.__serviceName, name)
-        return AuthServiceProxy(self.__serviceURL, name)
+        return AuthServiceProxy(self.__serviceURL, name, self.__timeout,
+                                pool=self.__pool)
 
-    def __call__(self, *args):
-        self.__idcnt += 1
+    def timeout_(self, timeout):
+        """Returns a proxy sharing this one's connection pool whose calls
+        time out after ``timeout`` seconds."""
+        return AuthServiceProxy(self.__serviceURL, self.__serviceName, timeout,
+                                pool=self.__pool)
 
+    def __call__(self, *args):
         postdata = json.dumps({
              'version': '1.1',
              'method': self.__serviceName,
              'params': args,
-             'id': self.__idcnt})
-        self.__conn.request('POST', self.__url.path, postdata,
-                 { 'Host' : self.__url.hostname,
-                     'User-Agent' : USER_AGENT,
-                     'Authorization' : self.__authhdr,
-                     'Content-type' : 'application/json' })
-
-        httpresp = self.__conn.getresponse()
-        if httpresp is None:
-            raise JSONRPCException({
-              'code' : -342, 'message' : 'missing HTTP response from server'})
-
-        resp = json.loads(httpresp.read(), parse_float=decimal.Decimal)
-        #print resp
+             'id': next(_id_counter)})
+        resp = self._request(postdata)
         if resp['error'] != None:
             raise JSONRPCException(unicode(resp['error']))
         elif 'result' not in resp:
@@ -102,4 +178,72 @@ class AuthServiceProxy(object):
         else:
             return resp['result']
 
+    def batch_(self, rpc_calls):
+        """Sends several calls in one JSON-RPC 2.0 batch request.
+
+        Takes a list of ``[method, param1, param2, ...]`` lists and
+        returns the results in the same order. A call that failed on the
+        server does not abort the batch; its slot holds the
+        ``JSONRPCException`` instead of a result.
+        """
+        if not rpc_calls:
+            return []
+        batch_data = []
+        for index, rpc_call in enumerate(rpc_calls):
+            batch_data.append({
+                'jsonrpc': '2.0',
+                'method': rpc_call[0],
+                'params': list(rpc_call[1:]),
+                'id': index})
+
+        responses = self._request(json.dumps(batch_data))
+        if not isinstance(responses, list):
+            # bitcoind answers a malformed batch with a single error object
+            raise JSONRPCException(unicode(responses.get('error')))
+
+        results = [JSONRPCException({
+            'code' : -343, 'message' : 'missing JSON-RPC result'})
+            for rpc_call in rpc_calls]
+        for resp in responses:
+            index = resp.get('id')
+            if not isinstance(index, (int, long)) or index < 0 or index >= len(results):
+                continue
+            if resp.get('error') != None:
+                results[index] = JSONRPCException(unicode(resp['error']))
+            elif 'result' in resp:
+                results[index] = resp['result']
+        return results
+
+    def _request(self, postdata):
+        headers = { 'Host' : self.__url.hostname,
+                    'User-Agent' : USER_AGENT,
+                    'Authorization' : self.__authhdr,
+                    'Content-type' : 'application/json' }
+        conn, reused = self.__pool.get(self.__timeout)
+        try:
+            try:
+                conn.request('POST', self.__url.path, postdata, headers)
+            except socket.error, e:
+                # Sending on a reused socket failed, so bitcoind never got
+                # the request and one retry on a fresh connection is safe.
+                # Errors while reading the response are never retried, the
+                # call (e.g. sendmany) may already have been executed.
+                if not reused or isinstance(e, socket.timeout):
+                    raise
+                conn.close()
+                conn = self.__pool.new_connection(self.__timeout)
+                conn.request('POST', self.__url.path, postdata, headers)
+            httpresp = conn.getresponse()
+            if httpresp is None:
+                raise JSONRPCException({
+                  'code' : -342, 'message' : 'missing HTTP response from server'})
+            body = httpresp.read()
+        except:
+            self.__pool.discard(conn)
+            raise
+        if httpresp.will_close:
+            self.__pool.discard(conn)
+        else:
+            self.__pool.put(conn)
 
+        return json.loads(body, parse_float=decimal.Decimal)
@@ -0,0 +1,140 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Sum
+from django_bitcoin.models import BitcoinAddress, Wallet, WalletConcurrencyError, WalletTransaction
+from decimal import Decimal
+from optparse import make_option
+import random
+import threading
+import time
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[int(round(fraction * (len(values) - 1)))]
+
+
+class Command(BaseCommand):
+    help = """Benchmarks Wallet.send_to_wallet with concurrent workers doing
+    random transfers between benchmark wallets, then validates the balances.
+    Run it against a test database, the wallets are funded without bitcoind.
+    """
+
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=8,
+                    help='Concurrent worker threads, each with its own database connection'),
+        make_option('--wallets', type='int', default=20,
+                    help='Number of wallets transferring between each other'),
+        make_option('--transfers', type='int', default=100,
+                    help='Transfers per worker'),
+        make_option('--hot', type='float', default=0,
+                    help='Fraction of transfers sent from the first wallet'),
+        make_option('--serialize-hot', action='store_true', default=False,
+                    help='Serialize the transfers of the first wallet with a row lock'),
+        make_option('--keep', action='store_true', default=False,
+                    help="Don't delete the benchmark wallets afterwards"),
+    )
+
+    def handle(self, *args, **options):
+        wallet_count = max(options['wallets'], 2)
+        funding = Decimal("1")
+        wallet_ids = []
+        for i in range(wallet_count):
+            w = Wallet.objects.create(label="benchmark")
+            BitcoinAddress.objects.create(address="benchmark-%d-%d" % (w.id, random.randint(0, 10 ** 9)),
+                                          wallet=w, active=True, migrated_to_transactions=False,
+                                          least_received=funding, least_received_confirmed=funding)
+            Wallet.objects.update_ledger(w.id, funding, funding)
+            wallet_ids.append(w.id)
+        if options['serialize_hot']:
+            Wallet.objects.filter(id=wallet_ids[0]).update(serialize_transfers=True)
+
+        stats = {'latencies': [], 'conflicts': 0, 'failed': 0, 'insufficient': 0, 'errors': 0}
+        stats_lock = threading.Lock()
+
+        def worker():
+            rnd = random.Random()
+            latencies = []
+            counts = {'conflicts': 0, 'failed': 0, 'insufficient': 0, 'errors': 0}
+            try:
+                for i in range(options['transfers']):
+                    if rnd.random() < options['hot']:
+                        sender = wallet_ids[0]
+                    else:
+                        sender = rnd.choice(wallet_ids)
+                    receiver = rnd.choice([wallet_id for wallet_id in wallet_ids if wallet_id != sender])
+                    amount = Decimal(rnd.randint(1, 10000)) / Decimal(10 ** 8)
+                    start = time.time()
+                    wallet = Wallet.objects.get(id=sender)
+                    try:
+                        wallet.send_to_wallet(Wallet.objects.get(id=receiver), amount, "benchmark")
+                        latencies.append(time.time() - start)
+                    except WalletConcurrencyError:
+                        counts['failed'] += 1
+                    except Exception as e:
+                        if "Trying to send too much" in unicode(e):
+                            counts['insufficient'] += 1
+                        else:
+                            print "transfer error:", e
+                            counts['errors'] += 1
+                    counts['conflicts'] += getattr(wallet, 'transfer_retries', 0)
+            finally:
+                connection.close()
+                with stats_lock:
+                    stats['latencies'] += latencies
+                    for key, value in counts.items():
+                        stats[key] += value
+
+        workers = [threading.Thread(target=worker) for i in range(options['workers'])]
+        started = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        elapsed = time.time() - started
+
+        latencies = sorted(stats['latencies'])
+        attempted = options['workers'] * options['transfers']
+        print "%d workers, %d wallets, %d transfers attempted" % (options['workers'], wallet_count, attempted)
+        print "completed %d in %.2fs, %.1f transfers/s" % (len(latencies), elapsed, len(latencies) / elapsed)
+        print "latency p50 %.1fms p99 %.1fms max %.1fms" % (percentile(latencies, 0.5) * 1000,
+                                                            percentile(latencies, 0.99) * 1000,
+                                                            (latencies[-1] if latencies else 0) * 1000)
+        print "concurrency retries %d (%.2f per transfer), gave up %d, insufficient funds %d, other errors %d" % (
+            stats['conflicts'], float(stats['conflicts']) / max(attempted, 1), stats['failed'],
+            stats['insufficient'], stats['errors'])
+
+        problems = self.validate(wallet_ids, funding)
+        for problem in problems:
+            print problem
+        print "balance check: %d errors" % len(problems)
+
+        if not options['keep']:
+            WalletTransaction.objects.filter(from_wallet__id__in=wallet_ids).delete()
+            BitcoinAddress.objects.filter(wallet__id__in=wallet_ids).delete()
+            Wallet.objects.filter(id__in=wallet_ids).delete()
+
+    def validate(self, wallet_ids, funding):
+        transactions = WalletTransaction.objects.filter(from_wallet__id__in=wallet_ids).order_by()
+        received = dict(transactions.values_list('to_wallet').annotate(Sum('amount')))
+        sent = dict(transactions.values_list('from_wallet').annotate(Sum('amount')))
+        problems = []
+        stale = 0
+        total = Decimal(0)
+        for wallet_id, last_balance, balance_confirmed in Wallet.objects.filter(id__in=wallet_ids)\
+                .values_list('id', 'last_balance', 'balance_confirmed'):
+            computed = funding + received.get(wallet_id, 0) - sent.get(wallet_id, 0)
+            total += computed
+            if computed < 0:
+                problems.append("wallet %s negative balance %s" % (wallet_id, computed))
+            if balance_confirmed != computed:
+                problems.append("wallet %s ledger %s computed %s" % (wallet_id, balance_confirmed, computed))
+            if last_balance != computed:
+                # receivers' last_balance is caught up by a celery task
+                stale += 1
+        if total != funding * len(wallet_ids):
+            problems.append("total %s, should be %s" % (total, funding * len(wallet_ids)))
+        if stale:
+            print "%d wallets with a stale last_balance" % stale
+        return problems
@@ -35,9 +35,10 @@ class Command(NoArgsCommand):
                 if len(db_addresses) == 0:
                     return
                 for ba in db_addresses:
-                    if ba.address in addresses.keys() and\
+                    if ba.address in addresses and\
                             ba.least_received < addresses[ba.address]:
-                        ba.query_bitcoind()
-                        ba.query_bitcoind(0)
+                        # listreceivedbyaddress already returned the
+                        # unconfirmed total, no per-address round trip
+                        ba.query_unconfirmed_deposits(received=addresses[ba.address])
                     last_id = min(ba.id, last_id)
                 print "finished 1000 scan", time() - start_time, last_id
@@ -60,6 +60,8 @@ class Command(BaseCommand):
                     elif s < ba.least_received_confirmed:
                         print "too little, address", ba.address, ba.least_received_confirmed, s
                     BitcoinAddress.objects.filter(id=ba.id).update(migrated_to_transactions=True)
+                    # the deposits above now carry the confirmed amount
+                    Wallet.objects.update_ledger(ba.wallet_id, confirmed=-ba.least_received_confirmed)
                 flush_transaction()
                 wt_sum = WalletTransaction.objects.filter(deposit_address=ba).aggregate(Sum('amount'))['amount__sum'] or Decimal(0)
                 if wt_sum != ba.least_received_confirmed:
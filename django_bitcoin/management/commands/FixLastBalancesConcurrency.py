@@ -1,13 +1,96 @@
-from django.core.management.base import NoArgsCommand
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction as db_transaction
+from django.db.models import Max, Min
 from django_bitcoin.models import Wallet
+from optparse import make_option
+import multiprocessing
+import time
 
+# Guarded by the values that were read, so a wallet that made a transfer
+# in the meantime is left alone
+UPDATE_SQL = """
+UPDATE django_bitcoin_wallet SET last_balance = %s
+ WHERE id = %s AND last_balance = %s AND transaction_counter = %s
+"""
 
-class Command(NoArgsCommand):
-    help = """fix balances
+PROGRESS_SECONDS = 5
+
+
+def fix_range(worker, min_id, max_id, chunk_size, dry_run):
+    """Fixes last_balance of the wallets with ids min_id..max_id, returns
+    (checked, changed)."""
+    total = Wallet.objects.filter(id__gte=min_id, id__lte=max_id).count()
+    started = last_report = time.time()
+    checked = changed = 0
+    for ids in Wallet.objects.id_chunks(chunk_size, min_id, max_id):
+        current = dict((wallet_id, (last_balance, counter)) for wallet_id, last_balance, counter
+                       in Wallet.objects.filter(id__in=ids).values_list('id', 'last_balance', 'transaction_counter'))
+        rows = []
+        for wallet_id, balance in Wallet.objects.iter_balances(ids, True, chunk_size):
+            last_balance, counter = current[wallet_id]
+            if balance != last_balance:
+                rows.append((balance, wallet_id, last_balance, counter))
+        if rows and not dry_run:
+            with db_transaction.atomic():
+                connection.cursor().executemany(UPDATE_SQL, rows)
+        checked += len(ids)
+        changed += len(rows)
+        now = time.time()
+        if now - last_report >= PROGRESS_SECONDS or checked >= total:
+            last_report = now
+            rate = checked / max(now - started, 0.001)
+            print "[%d] %d/%d wallets, %d changed, %.0f wallets/s, ETA %ds" % (
+                worker, checked, total, changed, rate, max(total - checked, 0) / rate)
+    return checked, changed
+
+
+def fix_range_star(args):
+    try:
+        return fix_range(*args)
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    help = """Recomputes last_balance of every wallet, the confirmed balance
+    from its addresses and transactions, and writes only the ones that changed.
     """
 
-    def handle_noargs(self, **options):
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', type='int', default=300,
+                    help='Wallets per balance query and update batch'),
+        make_option('--processes', type='int', default=1,
+                    help='Split the wallet id range across this many processes'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help='Only count the wallets that would change'),
+    )
+
+    def handle(self, *args, **options):
         print "starting..."
-        for w in Wallet.objects.all():
-            w.last_balance = w.total_balance()
-            w.save()
+        bounds = Wallet.objects.aggregate(Min('id'), Max('id'))
+        if bounds['id__min'] is None:
+            print "no wallets"
+            return
+        processes = max(options['processes'], 1)
+        step = (bounds['id__max'] - bounds['id__min']) // processes + 1
+        ranges = [(worker, bounds['id__min'] + worker * step,
+                   min(bounds['id__min'] + (worker + 1) * step - 1, bounds['id__max']),
+                   options['chunk_size'], options['dry_run'])
+                  for worker in range(processes)]
+        started = time.time()
+        if processes == 1:
+            results = [fix_range(*ranges[0])]
+        else:
+            # the workers must not share the parent's database connection
+            connection.close()
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(fix_range_star, ranges)
+            finally:
+                pool.close()
+                pool.join()
+        checked = sum(result[0] for result in results)
+        changed = sum(result[1] for result in results)
+        print "done, %d wallets checked, %d %s in %.1fs" % (
+            checked, changed, "would change" if options['dry_run'] else "changed", time.time() - started)
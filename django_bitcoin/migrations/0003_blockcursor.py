@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bitcoin', '0002_auto_20140913_1904'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BlockCursor',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=50)),
+                ('block_height', models.IntegerField(default=None, null=True)),
+                ('block_hash', models.CharField(default=None, max_length=64, null=True, blank=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from decimal import Decimal
+
+
+LEDGER_SQL = """
+UPDATE django_bitcoin_wallet SET
+ balance_confirmed =
+  COALESCE((SELECT SUM(least_received_confirmed) FROM django_bitcoin_bitcoinaddress ba
+            WHERE ba.wallet_id=django_bitcoin_wallet.id AND ba.migrated_to_transactions=%s), 0)
+  + COALESCE((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt
+              WHERE wt.to_wallet_id=django_bitcoin_wallet.id), 0)
+  - COALESCE((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt
+              WHERE wt.from_wallet_id=django_bitcoin_wallet.id), 0),
+ balance_unconfirmed =
+  COALESCE((SELECT SUM(least_received) FROM django_bitcoin_bitcoinaddress ba
+            WHERE ba.wallet_id=django_bitcoin_wallet.id), 0)
+  + COALESCE((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt
+              WHERE wt.to_wallet_id=django_bitcoin_wallet.id AND wt.from_wallet_id IS NOT NULL), 0)
+  - COALESCE((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt
+              WHERE wt.from_wallet_id=django_bitcoin_wallet.id), 0)
+"""
+
+
+def fill_ledger_balances(apps, schema_editor):
+    schema_editor.connection.cursor().execute(LEDGER_SQL, [False])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bitcoin', '0003_blockcursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='balance_confirmed',
+            field=models.DecimalField(default=Decimal('0'), max_digits=16, decimal_places=8),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='wallet',
+            name='balance_unconfirmed',
+            field=models.DecimalField(default=Decimal('0'), max_digits=16, decimal_places=8),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_ledger_balances),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bitcoin', '0004_wallet_ledger_balance'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='wallettransaction',
+            index_together=set([('from_wallet', 'created_at'), ('to_wallet', 'created_at')]),
+        ),
+    ]
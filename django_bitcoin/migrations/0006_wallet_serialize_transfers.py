@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bitcoin', '0005_wallettransaction_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='serialize_transfers',
+            field=models.BooleanField(default=False),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_bitcoin', '0006_wallet_serialize_transfers'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outgoingtransaction',
+            name='to_bitcoinaddress',
+            field=models.CharField(max_length=90, blank=True),
+        ),
+        migrations.AlterField(
+            model_name='wallettransaction',
+            name='to_bitcoinaddress',
+            field=models.CharField(max_length=90, blank=True),
+        ),
+    ]
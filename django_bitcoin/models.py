@@ -7,13 +7,13 @@ from django.utils.translation import ugettext_lazy as _
 from django.core import urlresolvers
 from django.db import transaction as db_transaction
 from django.db import models
-from django.utils import importlib, timezone
+from django.utils import dateparse, importlib, timezone
 
 from decimal import Decimal
 
 from . import settings
 
-from .fields.utils import is_valid_btc_address
+from .fields.utils import parse_address
 from .bitcoind import bitcoind
 from .locking import CacheLock
 
@@ -24,6 +24,10 @@ from . import tasks
 import django.dispatch
 
 import datetime
+import logging
+import random
+import re
+import time
 
 
 # initialize the conversion module
@@ -33,10 +37,16 @@ for dottedpath in settings.BITCOIN_CURRENCIES:
     klass = getattr(importlib.import_module(mod), func)
     currency.exchange.register_currency(klass())
 
+logger = logging.getLogger(__name__)
+
 balance_changed = django.dispatch.Signal(providing_args=["changed", "transaction", "bitcoinaddress"])
 balance_changed_confirmed = django.dispatch.Signal(providing_args=["changed", "transaction", "bitcoinaddress"])
 
 
+class WalletConcurrencyError(Exception):
+    """A transfer lost the race on the sending wallet's balance."""
+
+
 class Transaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     amount = models.DecimalField(
@@ -73,7 +83,7 @@ class OutgoingTransaction(models.Model):
     executed_at = models.DateTimeField(null=True, default=None)
     under_execution = models.BooleanField(default=False)  # execution fail
     to_bitcoinaddress = models.CharField(
-        max_length=50,
+        max_length=90,
         blank=True)
     amount = models.DecimalField(
         max_digits=16,
@@ -116,17 +126,26 @@ class BitcoinAddress(models.Model):
                         balance_changed_confirmed.send(sender=self.wallet,
                                                        changed=(deposit_tx.amount), bitcoinaddress=self)
 
-                updated = BitcoinAddress.objects.select_for_update().filter(id=self.id,
-                                                                            least_received_confirmed=self.least_received_confirmed).update(
-                    least_received_confirmed=self.least_received_confirmed + deposit_tx.amount)
+                with db_transaction.atomic():
+                    updated = BitcoinAddress.objects.select_for_update().filter(id=self.id,
+                                                                                least_received_confirmed=self.least_received_confirmed).update(
+                        least_received_confirmed=self.least_received_confirmed + deposit_tx.amount)
+                    if updated and self.wallet_id and not self.migrated_to_transactions:
+                        # migrated addresses are counted through their deposit WalletTransaction
+                        Wallet.objects.update_ledger(self.wallet_id, confirmed=deposit_tx.amount)
 
                 if self.wallet and updated:
                     DepositTransaction.objects.select_for_update().filter(id=deposit_tx.id).update(under_execution=True)
                     deposit_tx.under_execution = True
                     self.least_received_confirmed = self.least_received_confirmed + deposit_tx.amount
                     if self.least_received < self.least_received_confirmed:
-                        updated = BitcoinAddress.objects.select_for_update().filter(id=self.id).update(
-                            least_received=self.least_received_confirmed)
+                        with db_transaction.atomic():
+                            updated = BitcoinAddress.objects.select_for_update().filter(id=self.id, least_received=self.least_received).update(
+                                least_received=self.least_received_confirmed)
+                            if updated:
+                                Wallet.objects.update_ledger(self.wallet_id,
+                                                             unconfirmed=self.least_received_confirmed - self.least_received)
+                                self.least_received = self.least_received_confirmed
                     if self.migrated_to_transactions:
                         wt = WalletTransaction.objects.create(to_wallet=self.wallet, amount=deposit_tx.amount, description=self.address,
                                                               deposit_address=self)
@@ -140,14 +159,22 @@ class BitcoinAddress(models.Model):
                 # raise Exception("Should be never this way")
             return r
 
-    def query_unconfirmed_deposits(self):
-        r = bitcoind.total_received(self.address, minconf=0)
+    def query_unconfirmed_deposits(self, received=None):
+        """Updates least_received from bitcoind. Pass ``received`` when the
+        unconfirmed total was already fetched, e.g. in a batch."""
+        if received is None:
+            r = bitcoind.total_received(self.address, minconf=0)
+        else:
+            r = received
         if r > self.least_received:
             transaction_amount = r - self.least_received
             if settings.BITCOIN_TRANSACTION_SIGNALING:
                 if self.wallet:
                     balance_changed.send(sender=self.wallet, changed=(transaction_amount), bitcoinaddress=self)
-            updated = BitcoinAddress.objects.select_for_update().filter(id=self.id, least_received=self.least_received).update(least_received=r)
+            with db_transaction.atomic():
+                updated = BitcoinAddress.objects.select_for_update().filter(id=self.id, least_received=self.least_received).update(least_received=r)
+                if updated and self.wallet_id:
+                    Wallet.objects.update_ledger(self.wallet_id, unconfirmed=transaction_amount)
             if updated:
                 self.least_received = r
 
@@ -165,23 +192,89 @@ class BitcoinAddress(models.Model):
         return self.address
 
 
+def skip_locked_version_ok(vendor, version):
+    """True if a server of ``vendor`` with the ``version`` string reported
+    by the database supports SELECT ... FOR UPDATE SKIP LOCKED
+    (PostgreSQL 9.5+, MySQL 8.0.1+, MariaDB 10.6+)."""
+    numbers = [int(n) for n in re.findall(r"\d+", version)[:3]]
+    if vendor == 'postgresql':
+        # server_version_num, e.g. 90500
+        return bool(numbers) and numbers[0] >= 90500
+    if vendor == 'mysql':
+        if 'mariadb' in version.lower():
+            return numbers >= [10, 6]
+        return numbers >= [8, 0, 1]
+    return False
+
+
+# connection alias -> whether its server supports SKIP LOCKED
+_skip_locked_support = {}
+
+
+def skip_locked_supported(connection):
+    """Checks the server version once per database connection alias."""
+    if connection.alias not in _skip_locked_support:
+        supported = False
+        if connection.vendor in ('postgresql', 'mysql'):
+            cursor = connection.cursor()
+            if connection.vendor == 'postgresql':
+                cursor.execute("SHOW server_version_num")
+            else:
+                cursor.execute("SELECT VERSION()")
+            supported = skip_locked_version_ok(connection.vendor, cursor.fetchone()[0])
+        if not supported:
+            logger.info("%s database without SKIP LOCKED, using optimistic address allocation",
+                        connection.vendor)
+        _skip_locked_support[connection.alias] = supported
+    return _skip_locked_support[connection.alias]
+
+
+def claim_free_address():
+    """
+    Marks the next free BitcoinAddress active and returns it, or None if
+    the pool is empty. Rows locked by concurrent claims are skipped, so
+    workers allocating at the same time never wait on or collide with
+    each other. Needs a database for which skip_locked_supported is True.
+    """
+    from django.db import connection
+    table = BitcoinAddress._meta.db_table
+    with db_transaction.atomic():
+        cursor = connection.cursor()
+        cursor.execute("SELECT id FROM " + table +
+                       " WHERE active=%s AND wallet_id IS NULL AND least_received<=0"
+                       " ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED", [False])
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        cursor.execute("UPDATE " + table + " SET active=%s WHERE id=%s", [True, row[0]])
+    return BitcoinAddress.objects.get(id=row[0])
+
+
 def new_bitcoin_address():
+    from django.db import connection
+    if settings.BITCOIN_ADDRESS_SKIP_LOCKED and skip_locked_supported(connection):
+        while True:
+            bp = claim_free_address()
+            if bp is not None:
+                print 'returning bp', bp
+                schedule_payment_queue_refill()
+                return bp
+            refill_empty_payment_queue()
+            print "refilling queue..."
     while True:
-        db_transaction.enter_transaction_management()
-        db_transaction.commit()
         bp = BitcoinAddress.objects.filter(Q(active=False) & Q(wallet__isnull=True) &
-                                           Q(least_received__lte=0))
+                                           Q(least_received__lte=0)).order_by("id")[:1]
         if len(bp) < 1:
-            refill_payment_queue()
-            db_transaction.commit()
+            refill_empty_payment_queue()
             print "refilling queue...", bp
         else:
             bp = bp[0]
-            updated = BitcoinAddress.objects.select_for_update().filter(Q(id=bp.id) & Q(active=False) & Q(wallet__isnull=True) &
-                                                                        Q(least_received__lte=0)).update(active=True)
-            db_transaction.commit()
+            with db_transaction.atomic():
+                updated = BitcoinAddress.objects.select_for_update().filter(Q(id=bp.id) & Q(active=False) & Q(wallet__isnull=True) &
+                                                                            Q(least_received__lte=0)).update(active=True)
             if updated:
                 print 'returning bp', bp
+                schedule_payment_queue_refill()
                 return bp
             else:
                 print "wallet transaction concurrency:", bp.address
@@ -351,7 +444,7 @@ class WalletTransaction(models.Model):
         null=True,
         related_name="received_transactions")
     to_bitcoinaddress = models.CharField(
-        max_length=50,
+        max_length=90,
         blank=True)
     outgoing_transaction = models.ForeignKey('OutgoingTransaction', null=True, default=None)
     amount = models.DecimalField(
@@ -364,6 +457,13 @@ class WalletTransaction(models.Model):
     txid = models.CharField(max_length=100, blank=True, null=True)
     deposit_transaction = models.OneToOneField(DepositTransaction, null=True)
 
+    class Meta:
+        # per-wallet history in date order, see Wallet.history and statement
+        index_together = [
+            ('from_wallet', 'created_at'),
+            ('to_wallet', 'created_at'),
+        ]
+
     def __unicode__(self):
         if self.from_wallet and self.to_wallet:
             return u"Wallet transaction " + unicode(self.amount)
@@ -373,6 +473,31 @@ class WalletTransaction(models.Model):
             return u"Deposit " + unicode(self.amount)
         return u"Fee " + unicode(self.amount)
 
+    def save(self, *args, **kwargs):
+        if self.pk:
+            return super(WalletTransaction, self).save(*args, **kwargs)
+        # the insert and the balance change commit or roll back together
+        with db_transaction.atomic():
+            super(WalletTransaction, self).save(*args, **kwargs)
+            for wallet_id, confirmed, unconfirmed in self.ledger_changes():
+                Wallet.objects.update_ledger(wallet_id, confirmed, unconfirmed)
+
+    def ledger_changes(self):
+        """
+        Returns (wallet_id, confirmed, unconfirmed) balance changes caused
+        by this transaction. Deposits only move the confirmed balance, the
+        unconfirmed one already counted them at the receiving address.
+        """
+        changes = []
+        if self.from_wallet_id:
+            changes.append((self.from_wallet_id, -self.amount, -self.amount))
+        if self.to_wallet_id:
+            if self.from_wallet_id:
+                changes.append((self.to_wallet_id, self.amount, self.amount))
+            else:
+                changes.append((self.to_wallet_id, self.amount, Decimal(0)))
+        return changes
+
     def clean(self):
         from django.core.exceptions import ValidationError
         if not self.from_wallet and not self.to_wallet:
@@ -407,6 +532,95 @@ class WalletTransaction(models.Model):
         return (unconfirmed, confirmed, transactions)
 
 
+BALANCES_SQL = """
+SELECT wallet_id, SUM(amount) FROM (
+ SELECT ba.wallet_id AS wallet_id, ba.%(received_field)s AS amount
+  FROM django_bitcoin_bitcoinaddress ba WHERE ba.wallet_id IN (%(ids)s)%(address_filter)s
+ UNION ALL
+ SELECT wt.to_wallet_id AS wallet_id, wt.amount AS amount
+  FROM django_bitcoin_wallettransaction wt WHERE wt.to_wallet_id IN (%(ids)s)%(transfer_filter)s
+ UNION ALL
+ SELECT wt.from_wallet_id AS wallet_id, -wt.amount AS amount
+  FROM django_bitcoin_wallettransaction wt WHERE wt.from_wallet_id IN (%(ids)s)
+) balance_rows GROUP BY wallet_id
+"""
+
+# Three id lists per query, keeps SQLite below its 999 parameter limit
+BALANCES_SQL_CHUNK_SIZE = 300
+
+
+class WalletManager(models.Manager):
+
+    def total_balances_sql(self, wallet_ids, confirmed=True):
+        """
+        Returns {wallet_id: balance} computed from the addresses and
+        transactions with one grouped, parameterized query per chunk of
+        ids, on any database backend. Wallets without rows are missing.
+        """
+        from django.db import connections
+        cursor = connections[self.db].cursor()
+        balances = {}
+        for ids in utils.chunks(list(wallet_ids), BALANCES_SQL_CHUNK_SIZE):
+            placeholders = ", ".join(["%s"] * len(ids))
+            if confirmed:
+                sql = BALANCES_SQL % {'ids': placeholders,
+                                      'received_field': 'least_received_confirmed',
+                                      'address_filter': ' AND ba.migrated_to_transactions = %s',
+                                      'transfer_filter': ''}
+                params = list(ids) + [False] + list(ids) + list(ids)
+            else:
+                sql = BALANCES_SQL % {'ids': placeholders,
+                                      'received_field': 'least_received',
+                                      'address_filter': '',
+                                      'transfer_filter': ' AND wt.from_wallet_id IS NOT NULL'}
+                params = list(ids) * 3
+            cursor.execute(sql, params)
+            for wallet_id, balance in cursor.fetchall():
+                # SQLite hands out floats for decimal sums
+                balances[wallet_id] = utils.quantitize_bitcoin(Decimal(str(balance or 0)))
+        return balances
+
+    def id_chunks(self, chunk_size=BALANCES_SQL_CHUNK_SIZE, min_id=None, max_id=None):
+        """Yields lists of wallet ids in id order, read with keyset
+        pagination so the table is never loaded at once."""
+        ids = self.order_by('id').values_list('id', flat=True)
+        if max_id is not None:
+            ids = ids.filter(id__lte=max_id)
+        last_id = min_id - 1 if min_id is not None else None
+        while True:
+            chunk = ids.filter(id__gt=last_id) if last_id is not None else ids
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                return
+            yield chunk
+            last_id = chunk[-1]
+
+    def iter_balances(self, ids=None, confirmed=True, chunk_size=BALANCES_SQL_CHUNK_SIZE):
+        """Yields (wallet_id, balance) for the given wallet ids, or for all
+        wallets in id order, one grouped query per chunk of wallets."""
+        if ids is None:
+            chunks = self.id_chunks(chunk_size)
+        else:
+            chunks = utils.chunks(list(ids), chunk_size)
+        for chunk in chunks:
+            balances = self.total_balances_sql(chunk, confirmed)
+            for wallet_id in chunk:
+                yield wallet_id, balances.get(wallet_id, Decimal(0))
+
+    def balances(self, ids=None, confirmed=True):
+        """Returns {wallet_id: balance} for the given wallet ids, or for
+        all wallets. Same numbers as Wallet.total_balance_sql."""
+        return dict(self.iter_balances(ids, confirmed))
+
+    def update_ledger(self, wallet_id, confirmed=Decimal(0), unconfirmed=Decimal(0)):
+        """Adds to the materialized balances of a wallet in one UPDATE."""
+        if not confirmed and not unconfirmed:
+            return 0
+        return self.filter(id=wallet_id).update(
+            balance_confirmed=models.F('balance_confirmed') + confirmed,
+            balance_unconfirmed=models.F('balance_unconfirmed') + unconfirmed)
+
+
 class Wallet(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -422,6 +636,18 @@ class Wallet(models.Model):
     transaction_counter = models.IntegerField(default=1)
     last_balance = models.DecimalField(default=Decimal(0), max_digits=16, decimal_places=8)
 
+    # Authoritative balances, changed in the same database transaction as
+    # the WalletTransaction or BitcoinAddress row that moves the funds.
+    # balance_unconfirmed also counts deposits waiting for confirmations.
+    balance_confirmed = models.DecimalField(default=Decimal(0), max_digits=16, decimal_places=8)
+    balance_unconfirmed = models.DecimalField(default=Decimal(0), max_digits=16, decimal_places=8)
+
+    # Transfers from the wallet lock its row and wait for each other
+    # instead of failing and retrying, for hot wallets with many senders
+    serialize_transfers = models.BooleanField(default=False)
+
+    objects = WalletManager()
+
     # track_transaction_value = models.BooleanField(default=False)
 
     # tries to update instantly, if not succesful updates using sql query (celery task)
@@ -461,9 +687,14 @@ class Wallet(models.Model):
             amount = Decimal(amount)
         amount = amount.quantize(Decimal('0.00000001'))
 
+        return self._retry_transfer(lambda: self._send_to_wallet(otherWallet, amount, description))
+
+    def _send_to_wallet(self, otherWallet, amount, description):
         with db_transaction.autocommit():
             db_transaction.enter_transaction_management()
             db_transaction.commit()
+            if self.serialize_transfers:
+                self._lock_for_transfer()
             if settings.BITCOIN_UNCONFIRMED_TRANSFERS:
                 avail = self.total_balance_unconfirmed()
             else:
@@ -485,7 +716,7 @@ class Wallet(models.Model):
                 .update(last_balance=new_balance, transaction_counter=self.transaction_counter + 1)
             if not updated:
                 print "wallet transaction concurrency:", new_balance, avail, self.transaction_counter, self.last_balance, self.total_balance()
-                raise Exception(_("Concurrency error with transactions. Please try again."))
+                raise WalletConcurrencyError(_("Concurrency error with transactions. Please try again."))
             # db_transaction.commit()
             # concurrency check end
             transaction = WalletTransaction.objects.create(
@@ -520,14 +751,22 @@ class Wallet(models.Model):
             amount = Decimal(amount)
         amount = amount.quantize(Decimal('0.00000001'))
 
-        if not is_valid_btc_address(str(address)):
+        parsed = parse_address(address, settings.BITCOIN_NETWORK)
+        if parsed is None:
             raise Exception(_("Not a valid bitcoin address") + ":" + address)
+        if parsed.kind == 'witness':
+            address = address.lower()
         if amount <= 0:
             raise Exception(_("Can't send zero or negative amounts"))
+        return self._retry_transfer(lambda: self._send_to_address(address, amount, description, expires_seconds))
+
+    def _send_to_address(self, address, amount, description, expires_seconds):
         # concurrency check
         with db_transaction.autocommit():
             db_transaction.enter_transaction_management()
             db_transaction.commit()
+            if self.serialize_transfers:
+                self._lock_for_transfer()
             avail = self.total_balance()
             updated = Wallet.objects.filter(Q(id=self.id)).update(last_balance=avail)
             if amount > avail:
@@ -538,7 +777,7 @@ class Wallet(models.Model):
                 .update(last_balance=new_balance, transaction_counter=self.transaction_counter + 1)
             if not updated:
                 print "address transaction concurrency:", new_balance, avail, self.transaction_counter, self.last_balance, self.total_balance()
-                raise Exception(_("Concurrency error with transactions. Please try again."))
+                raise WalletConcurrencyError(_("Concurrency error with transactions. Please try again."))
             # concurrency check end
             outgoing_transaction = OutgoingTransaction.objects.create(amount=amount, to_bitcoinaddress=address,
                                                                       expires_at=timezone.now() + datetime.timedelta(seconds=expires_seconds))
@@ -578,6 +817,31 @@ class Wallet(models.Model):
                                                changed=(Decimal(-1) * amount), transaction=bwt)
             return (bwt, None)
 
+    def _retry_transfer(self, transfer):
+        """
+        Calls transfer() and retries it after a WalletConcurrencyError, up
+        to BITCOIN_TRANSFER_RETRIES times with jittered exponential backoff.
+        The transaction_counter is re-read before every retry. The number
+        of retries of the last transfer is kept in transfer_retries.
+        """
+        self.transfer_retries = 0
+        while True:
+            try:
+                return transfer()
+            except WalletConcurrencyError:
+                if self.transfer_retries >= settings.BITCOIN_TRANSFER_RETRIES:
+                    raise
+            time.sleep(random.uniform(0, settings.BITCOIN_TRANSFER_RETRY_BACKOFF * 2 ** self.transfer_retries))
+            self.transfer_retries += 1
+            self.transaction_counter = Wallet.objects.filter(id=self.id)\
+                .values_list('transaction_counter', flat=True)[0]
+
+    def _lock_for_transfer(self):
+        """Locks the wallet row until the transfer's transaction ends, so
+        the counter check below it can't lose a race."""
+        self.transaction_counter = Wallet.objects.select_for_update().filter(id=self.id)\
+            .values_list('transaction_counter', flat=True)[0]
+
     def update_transaction_cache(self,
                                  mincf=settings.BITCOIN_MINIMUM_CONFIRMATIONS):
         """
@@ -623,25 +887,44 @@ class Wallet(models.Model):
         raise Exception("Incorrect minconf parameter")
 
     def total_balance_sql(self, confirmed=True):
-        from django.db import connection
-        cursor = connection.cursor()
-        if confirmed is False:
-            sql = """
-             SELECT IFNULL((SELECT SUM(least_received) FROM django_bitcoin_bitcoinaddress ba WHERE ba.wallet_id=%(id)s), 0)
-            + IFNULL((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt WHERE wt.to_wallet_id=%(id)s AND wt.from_wallet_id>0), 0)
-            - IFNULL((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt WHERE wt.from_wallet_id=%(id)s), 0) as total_balance;
-            """ % {'id': self.id}
-            cursor.execute(sql)
-            return cursor.fetchone()[0]
-        else:
-            sql = """
-             SELECT IFNULL((SELECT SUM(least_received_confirmed) FROM django_bitcoin_bitcoinaddress ba WHERE ba.wallet_id=%(id)s AND ba.migrated_to_transactions=0), 0)
-            + IFNULL((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt WHERE wt.to_wallet_id=%(id)s), 0)
-            - IFNULL((SELECT SUM(amount) FROM django_bitcoin_wallettransaction wt WHERE wt.from_wallet_id=%(id)s), 0) as total_balance;
-            """ % {'id': self.id}
-            cursor.execute(sql)
-            self.last_balance = cursor.fetchone()[0]
-            return self.last_balance
+        balance = Wallet.objects.total_balances_sql([self.id], confirmed).get(self.id, Decimal(0))
+        if confirmed:
+            self.last_balance = balance
+        return balance
+
+    def ledger_balance(self, confirmed=True):
+        """
+        Reads the materialized balance of the Wallet with a primary key
+        lookup, no matter how many transactions the wallet has.
+
+        With BITCOIN_LEDGER_VERIFY the balance is also aggregated from the
+        transactions, and the aggregate wins on a mismatch.
+        """
+        field = 'balance_confirmed' if confirmed else 'balance_unconfirmed'
+        balance = Wallet.objects.filter(id=self.id).values_list(field, flat=True)[0]
+        setattr(self, field, balance)
+        if settings.BITCOIN_LEDGER_VERIFY:
+            minconf = settings.BITCOIN_MINIMUM_CONFIRMATIONS if confirmed else 0
+            aggregated = self.total_received(minconf) - self.total_sent()
+            if aggregated != balance:
+                print "wallet ledger mismatch:", self.id, field, balance, aggregated
+                return aggregated
+        return balance
+
+    def rebuild_ledger_balance(self):
+        """
+        Recomputes the materialized balances from the addresses and
+        transactions. The wallet row is locked first, so ledger updates of
+        concurrent transactions wait and are applied on top of the result.
+        """
+        with db_transaction.atomic():
+            list(Wallet.objects.select_for_update().filter(id=self.id).values_list('id', flat=True))
+            confirmed = Wallet.objects.total_balances_sql([self.id], True).get(self.id, Decimal(0))
+            unconfirmed = Wallet.objects.total_balances_sql([self.id], False).get(self.id, Decimal(0))
+            Wallet.objects.filter(id=self.id).update(balance_confirmed=confirmed,
+                                                     balance_unconfirmed=unconfirmed)
+        self.balance_confirmed = confirmed
+        self.balance_unconfirmed = unconfirmed
 
     def total_balance(self, minconf=settings.BITCOIN_MINIMUM_CONFIRMATIONS):
         """
@@ -654,8 +937,10 @@ class Wallet(models.Model):
             #     elif mincof == 0:
             #         self.total_balance_sql(False)
             if minconf >= settings.BITCOIN_MINIMUM_CONFIRMATIONS:
-                self.last_balance = self.total_received(minconf) - self.total_sent()
+                self.last_balance = self.ledger_balance(confirmed=True)
                 return self.last_balance
+            elif minconf == 0:
+                return self.ledger_balance(confirmed=False)
             else:
                 return self.total_received(minconf) - self.total_sent()
         else:
@@ -684,14 +969,14 @@ class Wallet(models.Model):
 
     def total_balance_unconfirmed(self):
         if not settings.BITCOIN_UNCONFIRMED_TRANSFERS:
-            return self.total_received(0) - self.total_sent()
+            return self.ledger_balance(confirmed=False)
         else:
             x = self.balance()
             return x[0] + x[1]
 
     def unconfirmed_balance(self):
         if not settings.BITCOIN_UNCONFIRMED_TRANSFERS:
-            return self.total_received(0) - self.total_sent()
+            return self.ledger_balance(confirmed=False)
         else:
             return self.balance()[0]
 
@@ -718,36 +1003,183 @@ class Wallet(models.Model):
         """Returns the raw ammount ever sent by this wallet."""
         return self.sent_transactions.aggregate(models.Sum("amount"))['amount__sum'] or Decimal(0)
 
+    def statement(self, cursor=None, limit=50):
+        """
+        Returns one page of the wallet's transactions, oldest first, as
+        (entries, next_cursor). Each history_entry dict also has the running
+        confirmed ``balance`` after it. Pass next_cursor back to get the
+        following page, it is None on the last one.
+
+        Pages are found by keyset on (created_at, id) and the cursor carries
+        the running balance, so every page costs the same no matter how deep
+        into the history it is. The cursor is signed for this wallet, a
+        forged or foreign one raises ValueError. Deposits to addresses not
+        migrated to transactions have no place in the stream, they are part
+        of the opening balance.
+        """
+        from django.core import signing
+        salt = "django_bitcoin.statement.%d" % self.id
+        transactions = WalletTransaction.objects.filter(Q(to_wallet=self) | Q(from_wallet=self))
+        if cursor:
+            try:
+                created_at, last_id, balance = signing.loads(cursor, salt=salt)
+                created_at = dateparse.parse_datetime(created_at)
+                last_id = int(last_id)
+                balance = Decimal(balance)
+            except (signing.BadSignature, TypeError, ValueError):
+                created_at = None
+            if created_at is None:
+                raise ValueError("Invalid statement cursor: %r" % cursor)
+            transactions = transactions.filter(Q(created_at__gt=created_at) |
+                                               Q(created_at=created_at, id__gt=last_id))
+        else:
+            balance = self.addresses.filter(migrated_to_transactions=False).aggregate(
+                models.Sum("least_received_confirmed"))['least_received_confirmed__sum'] or Decimal(0)
+        transactions = list(transactions.select_related('from_wallet', 'to_wallet', 'deposit_address')
+                            .order_by('created_at', 'id')[:limit + 1])
+        entries = []
+        for t in transactions[:limit]:
+            entry = self.history_entry(t)
+            if t.to_wallet_id == self.id:
+                balance += t.amount
+            if t.from_wallet_id == self.id:
+                balance -= t.amount
+            entry['balance'] = balance
+            entries.append(entry)
+        next_cursor = None
+        if len(transactions) > limit:
+            last = entries[-1]['transaction']
+            next_cursor = signing.dumps([last.created_at.isoformat(), last.id, str(balance)], salt=salt)
+        return (entries, next_cursor)
+
     def has_history(self):
         """Returns True if this wallet was any transacion history."""
-        if self.received_transactions.all().count():
+        if self.received_transactions.exists():
             return True
-        if self.sent_transactions.all().count():
+        if self.sent_transactions.exists():
             return True
-        if filter(lambda x: x.received(), self.addresses.all()):
+        if self.addresses.filter(least_received_confirmed__gt=0).exists():
             return True
         return False
 
-    def merge_wallet(self, other_wallet):
-        if self.id > 0 and other_wallet.id > 0:
-            from django.db import connection, transaction
-            cursor = connection.cursor()
-            cursor.execute("UPDATE django_bitcoin_bitcoinaddress SET wallet_id=" + str(other_wallet.id) +
-                           " WHERE wallet_id=" + str(self.id))
-            cursor.execute("UPDATE django_bitcoin_wallettransaction SET from_wallet_id=" + str(other_wallet.id) +
-                           " WHERE from_wallet_id=" + str(self.id))
-            cursor.execute("UPDATE django_bitcoin_wallettransaction SET to_wallet_id=" + str(other_wallet.id) +
-                           " WHERE to_wallet_id=" + str(self.id))
-            cursor.execute("DELETE FROM django_bitcoin_wallettransaction WHERE to_wallet_id=from_wallet_id")
-            transaction.commit_unless_managed()
+    def history_entry(self, transaction):
+        """Describes a WalletTransaction as seen from this wallet."""
+        credit = transaction.to_wallet_id == self.id
+        if credit:
+            wallet = transaction.from_wallet
+            address = transaction.deposit_address.address if transaction.deposit_address_id else None
+        else:
+            wallet = transaction.to_wallet
+            address = transaction.to_bitcoinaddress or None
+        return {
+            'created_at': transaction.created_at,
+            'credit': credit,
+            'wallet': wallet,
+            'address': address,
+            'amount': transaction.amount,
+            'description': transaction.description,
+            'transaction': transaction,
+        }
+
+    def history(self, limit=50, offset=0):
+        """
+        Returns the deposits, transfers and outgoing transactions of the
+        wallet as one list of history_entry dicts, newest first.
 
+        Only ``offset + limit`` rows are read, in two queries no matter how
+        long the history is.
+        """
+        transactions = WalletTransaction.objects.filter(Q(to_wallet=self) | Q(from_wallet=self))\
+            .select_related('from_wallet', 'to_wallet', 'deposit_address')\
+            .order_by('-created_at', '-id')[:offset + limit]
+        entries = [self.history_entry(t) for t in transactions]
+        # deposits to addresses not migrated to transactions yet
+        for addr in self.addresses.filter(migrated_to_transactions=False, least_received_confirmed__gt=0)\
+                .order_by('-created_at')[:offset + limit]:
+            entries.append({
+                'created_at': addr.created_at,
+                'credit': True,
+                'wallet': None,
+                'address': addr.address,
+                'amount': addr.least_received_confirmed,
+                'description': addr.label or '',
+                'transaction': None,
+            })
+        entries.sort(key=lambda e: e['created_at'], reverse=True)
+        return entries[offset:offset + limit]
 
-def refill_payment_queue():
+    def merge_wallet(self, other_wallet):
+        if self.id > 0 and other_wallet.id > 0:
+            from django.db import connection
+            # moving the rows and rebuilding the balances commit together,
+            # with both wallet rows locked (in id order, against deadlocks)
+            with db_transaction.atomic():
+                list(Wallet.objects.select_for_update().filter(id__in=[self.id, other_wallet.id])
+                     .order_by('id').values_list('id', flat=True))
+                cursor = connection.cursor()
+                cursor.execute("UPDATE django_bitcoin_bitcoinaddress SET wallet_id=" + str(other_wallet.id) +
+                               " WHERE wallet_id=" + str(self.id))
+                cursor.execute("UPDATE django_bitcoin_wallettransaction SET from_wallet_id=" + str(other_wallet.id) +
+                               " WHERE from_wallet_id=" + str(self.id))
+                cursor.execute("UPDATE django_bitcoin_wallettransaction SET to_wallet_id=" + str(other_wallet.id) +
+                               " WHERE to_wallet_id=" + str(self.id))
+                cursor.execute("DELETE FROM django_bitcoin_wallettransaction WHERE to_wallet_id=from_wallet_id")
+                Wallet.objects.filter(id=self.id).update(balance_confirmed=Decimal(0),
+                                                         balance_unconfirmed=Decimal(0))
+                other_wallet.rebuild_ledger_balance()
+
+
+def refill_payment_queue(low_watermark=None):
+    """
+    Tops the pool of free addresses up to BITCOIN_ADDRESS_BUFFER_SIZE, if
+    it has fewer than ``low_watermark`` (default: the buffer size) left.
+    """
     c = BitcoinAddress.objects.filter(active=False, wallet=None).count()
     # print "count", c
-    if settings.BITCOIN_ADDRESS_BUFFER_SIZE > c:
-        for i in range(0, settings.BITCOIN_ADDRESS_BUFFER_SIZE - c):
-            BitcoinAddress.objects.create(address=bitcoind.create_address(), active=False)
+    if low_watermark is None:
+        low_watermark = settings.BITCOIN_ADDRESS_BUFFER_SIZE
+    if c < low_watermark and settings.BITCOIN_ADDRESS_BUFFER_SIZE > c:
+        addresses = bitcoind.create_addresses(settings.BITCOIN_ADDRESS_BUFFER_SIZE - c)
+        BitcoinAddress.objects.bulk_create([BitcoinAddress(address=address, active=False)
+                                            for address in addresses], batch_size=500)
+
+
+def refill_empty_payment_queue():
+    """Creates the one address a request is waiting for, the rest of the
+    pool is refilled in the background."""
+    BitcoinAddress.objects.create(address=bitcoind.create_address(), active=False)
+    schedule_payment_queue_refill()
+
+
+def schedule_payment_queue_refill():
+    """Queues a background refill, at most once per ten seconds."""
+    if cache.add("refill_payment_queue_scheduled", True, 10):
+        tasks.refill_payment_queue.delay()
+
+
+# Blockchain scanning state
+
+
+class BlockCursor(models.Model):
+    """Last block a blockchain scanning task has fully processed.
+
+    Kept in the database rather than the cache so a flushed memcached
+    doesn't make the next run rescan old blocks.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    block_height = models.IntegerField(null=True, default=None)
+    block_hash = models.CharField(max_length=64, blank=True, null=True, default=None)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.name, self.block_height)
+
+    def advance(self, block_height, block_hash):
+        self.block_height = block_height
+        self.block_hash = block_hash
+        BlockCursor.objects.filter(id=self.id).update(block_height=block_height,
+                                                      block_hash=block_hash,
+                                                      updated_at=timezone.now())
 
 
 # Historical prie storage
@@ -21,8 +21,11 @@
 # Ported from C code written by Laurent Haan (http://www.progressive-coding.com)
 
 import os, sys, time
+import collections
+import itertools
 import json
 import logging
+import multiprocessing
 import struct
 import StringIO
 import traceback
@@ -797,27 +800,30 @@ class Point( object ):
         return Point( self.__curve, x3, y3 )
 
     def __mul__( self, other ):
-        def leftmost_bit( x ):
-            assert x > 0
-            result = 1L
-            while result <= x: result = 2 * result
-            return result / 2
-
         e = other
         if self.__order: e = e % self.__order
         if e == 0: return INFINITY
         if self == INFINITY: return INFINITY
         assert e > 0
-        e3 = 3 * e
-        negative_self = Point( self.__curve, self.__x, -self.__y, self.__order )
-        i = leftmost_bit( e3 ) / 2
-        result = self
-        while i > 1:
-            result = result.double()
-            if ( e3 & i ) != 0 and ( e & i ) == 0: result = result + self
-            if ( e3 & i ) == 0 and ( e & i ) != 0: result = result + negative_self
-            i = i / 2
-        return result
+        p = self.__curve.p()
+        a = self.__curve.a()
+        if self.__order:
+            # generators get a precomputed table, kept for the process
+            table = generator_table( p, a, self.__x, self.__y )
+            result = _comb_multiply( table, e, p, a )
+        else:
+            result = _wnaf_multiply( ( self.__x, self.__y, 1 ), e, p, a )
+        return self.from_jacobian( result )
+
+    def from_jacobian( self, jacobian, z_inverse = None ):
+        """Returns the affine Point on this curve of Jacobian coordinates
+        ( X, Y, Z ), with one inversion of Z unless it is passed in."""
+        X, Y, Z = jacobian
+        if Z == 0: return INFINITY
+        p = self.__curve.p()
+        if z_inverse is None: z_inverse = inverse_mod( Z, p )
+        zz = z_inverse * z_inverse % p
+        return Point( self.__curve, X * zz % p, Y * zz * z_inverse % p )
 
     def __rmul__( self, other ):
         return self * other
@@ -863,6 +869,154 @@ def inverse_mod( a, m ):
     if ud > 0: return ud
     else: return ud + m
 
+def batch_inverse_mod( values, m ):
+    """Inverts all values with a single inverse_mod (Montgomery's trick)."""
+    prefix = []
+    acc = 1
+    for v in values:
+        prefix.append( acc )
+        acc = acc * v % m
+    inverse = inverse_mod( acc, m )
+    result = [ 0 ] * len( values )
+    for i in range( len( values ) - 1, -1, -1 ):
+        result[i] = inverse * prefix[i] % m
+        inverse = inverse * values[i] % m
+    return result
+
+# Jacobian coordinates: ( X, Y, Z ) is the affine point ( X/Z^2, Y/Z^3 ),
+# Z == 0 is the point at infinity. Additions and doublings need no
+# inversion, only the final conversion back to affine does.
+
+JACOBIAN_INFINITY = ( 0, 1, 0 )
+
+def jacobian_double( P, p, a ):
+    X1, Y1, Z1 = P
+    if Y1 == 0 or Z1 == 0: return JACOBIAN_INFINITY
+    YY = Y1 * Y1 % p
+    S = 4 * X1 * YY % p
+    if a:
+        M = ( 3 * X1 * X1 + a * pow( Z1, 4, p ) ) % p
+    else:
+        M = 3 * X1 * X1 % p
+    X3 = ( M * M - 2 * S ) % p
+    Y3 = ( M * ( S - X3 ) - 8 * YY * YY ) % p
+    Z3 = 2 * Y1 * Z1 % p
+    return ( X3, Y3, Z3 )
+
+def jacobian_add( P, Q, p, a ):
+    X1, Y1, Z1 = P
+    X2, Y2, Z2 = Q
+    if Z1 == 0: return Q
+    if Z2 == 0: return P
+    Z1Z1 = Z1 * Z1 % p
+    U2 = X2 * Z1Z1 % p
+    S2 = Y2 * Z1 * Z1Z1 % p
+    if Z2 == 1:
+        # mixed addition with an affine point
+        U1, S1 = X1, Y1
+    else:
+        Z2Z2 = Z2 * Z2 % p
+        U1 = X1 * Z2Z2 % p
+        S1 = Y1 * Z2 * Z2Z2 % p
+    if U1 == U2:
+        if S1 != S2: return JACOBIAN_INFINITY
+        return jacobian_double( P, p, a )
+    H = ( U2 - U1 ) % p
+    R = ( S2 - S1 ) % p
+    HH = H * H % p
+    HHH = H * HH % p
+    V = U1 * HH % p
+    X3 = ( R * R - HHH - 2 * V ) % p
+    Y3 = ( R * ( V - X3 ) - S1 * HHH ) % p
+    Z3 = Z1 * Z2 * H % p
+    return ( X3, Y3, Z3 )
+
+def jacobian_normalize( points, p ):
+    """Converts Jacobian points to ( x, y, 1 ) with one inversion."""
+    finite = [ P for P in points if P[2] != 0 ]
+    inverses = iter( batch_inverse_mod( [ P[2] for P in finite ], p ) )
+    result = []
+    for X, Y, Z in points:
+        if Z == 0:
+            result.append( JACOBIAN_INFINITY )
+            continue
+        zi = next( inverses )
+        zz = zi * zi % p
+        result.append( ( X * zz % p, Y * zz * zi % p, 1 ) )
+    return result
+
+WNAF_WIDTH = 5
+
+def wnaf( e, w = WNAF_WIDTH ):
+    """Width-w non-adjacent form of e, least significant digit first.
+    Digits are 0 or odd and below 2^(w-1) in absolute value."""
+    digits = []
+    while e:
+        if e & 1:
+            d = e & ( ( 1 << w ) - 1 )
+            if d >= 1 << ( w - 1 ): d -= 1 << w
+            e -= d
+        else:
+            d = 0
+        digits.append( d )
+        e >>= 1
+    return digits
+
+def _wnaf_multiply( P, e, p, a, w = WNAF_WIDTH ):
+    # P, 3P, 5P, ... ( 2^(w-1) - 1 )P
+    twice = jacobian_double( P, p, a )
+    odd = [ P ]
+    for i in range( ( 1 << ( w - 2 ) ) - 1 ):
+        odd.append( jacobian_add( odd[-1], twice, p, a ) )
+    odd = jacobian_normalize( odd, p )
+    result = JACOBIAN_INFINITY
+    for d in reversed( wnaf( e, w ) ):
+        result = jacobian_double( result, p, a )
+        if d > 0:
+            result = jacobian_add( result, odd[d >> 1], p, a )
+        elif d < 0:
+            x, y, z = odd[-d >> 1]
+            result = jacobian_add( result, ( x, p - y, z ), p, a )
+    return result
+
+# Fixed-base comb for generators: row i holds j * 16^i * G for j = 1..15,
+# so a 256 bit multiplication is at most 64 mixed additions.
+COMB_BITS = 4
+COMB_ROWS = 64
+_generator_tables = {}
+
+def _comb_table( G, p, a ):
+    points = []
+    base = G
+    for i in range( COMB_ROWS ):
+        row = [ base ]
+        for j in range( ( 1 << COMB_BITS ) - 2 ):
+            row.append( jacobian_add( row[-1], base, p, a ) )
+        points += row
+        base = jacobian_double( row[( 1 << ( COMB_BITS - 1 ) ) - 1], p, a )
+    points = jacobian_normalize( points, p )
+    size = ( 1 << COMB_BITS ) - 1
+    return [ points[i * size:( i + 1 ) * size] for i in range( COMB_ROWS ) ]
+
+def generator_table( p, a, x, y ):
+    key = ( p, a, x, y )
+    if key not in _generator_tables:
+        _generator_tables[key] = _comb_table( ( x, y, 1 ), p, a )
+    return _generator_tables[key]
+
+def _comb_multiply( table, e, p, a ):
+    if e >> ( COMB_BITS * COMB_ROWS ):
+        raise ValueError( "multiplier too large for the generator table" )
+    result = JACOBIAN_INFINITY
+    mask = ( 1 << COMB_BITS ) - 1
+    i = 0
+    while e:
+        j = e & mask
+        if j: result = jacobian_add( result, table[i][j - 1], p, a )
+        e >>= COMB_BITS
+        i += 1
+    return result
+
 class Signature( object ):
     def __init__( self, r, s ):
         self.r = r
@@ -1644,6 +1798,60 @@ def privkey2address(sec):
     public_key = GetPubKey(pkey, compressed)
     return public_key_to_bc_address(public_key)
 
+def _privkeys_to_addresses(keys):
+    # Every public key stays in Jacobian coordinates until all of them
+    # are normalized with a single inversion
+    table = generator_table(_p, _a, _Gx, _Gy)
+    secrets = []
+    for sec in keys:
+        b = ASecretToSecret(sec)
+        secret = int(b[0:32].encode('hex'), 16) if b else 0
+        secrets.append((secret, len(b) == 33) if 0 < secret < _r else None)
+    points = jacobian_normalize([_comb_multiply(table, s[0], _p, _a) if s else JACOBIAN_INFINITY
+                                 for s in secrets], _p)
+    addresses = []
+    for s, (x, y, z) in zip(secrets, points):
+        if not s:
+            addresses.append(None)
+        elif s[1]:
+            addresses.append(public_key_to_bc_address(('%02x%064x' % (2 + (y & 1), x)).decode('hex')))
+        else:
+            addresses.append(public_key_to_bc_address(('04%064x%064x' % (x, y)).decode('hex')))
+    return addresses
+
+def imap_bounded(pool, func, iterable, window):
+    """Like pool.imap, but reads iterable at most window items ahead of
+    the results that were consumed."""
+    iterable = iter(iterable)
+    pending = collections.deque(pool.apply_async(func, (item,))
+                                for item in itertools.islice(iterable, window))
+    while pending:
+        result = pending.popleft().get()
+        for item in itertools.islice(iterable, 1):
+            pending.append(pool.apply_async(func, (item,)))
+        yield result
+
+def privkeys2addresses(keys, workers=None, chunk_size=200):
+    """Yields the address of each private key in keys, in order, None for
+    invalid keys. The keys are read lazily in chunks of chunk_size, which
+    are spread over a pool of ``workers`` processes if given, with at most
+    two chunks per worker read ahead."""
+    keys = iter(keys)
+    chunks = iter(lambda: list(itertools.islice(keys, chunk_size)), [])
+    if not workers or workers <= 1:
+        for chunk in chunks:
+            for address in _privkeys_to_addresses(chunk):
+                yield address
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for addresses in imap_bounded(pool, _privkeys_to_addresses, chunks, 2 * workers):
+            for address in addresses:
+                yield address
+    finally:
+        pool.terminate()
+        pool.join()
+
 from optparse import OptionParser
 
 def main():
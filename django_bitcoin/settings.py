@@ -17,6 +17,18 @@ BITCOIN_ADDRESS_BUFFER_SIZE = getattr(
     settings,
     "BITCOIN_ADDRESS_BUFFER_SIZE",
     5)
+# Refill the address pool in the background when fewer free addresses
+# than this are left
+BITCOIN_ADDRESS_LOW_WATERMARK = getattr(
+    settings,
+    "BITCOIN_ADDRESS_LOW_WATERMARK",
+    max(BITCOIN_ADDRESS_BUFFER_SIZE // 2, 1))
+# Claim free addresses with SELECT ... FOR UPDATE SKIP LOCKED where the
+# database supports it
+BITCOIN_ADDRESS_SKIP_LOCKED = getattr(
+    settings,
+    "BITCOIN_ADDRESS_SKIP_LOCKED",
+    True)
 PAYMENT_VALID_HOURS = getattr(
     settings,
     "BITCOIND_PAYMENT_VALID_HOURS",
@@ -33,6 +45,28 @@ ESCROW_RELEASE_TIME_DAYS = getattr(
     settings,
     "BITCOIND_ESCROW_RELEASE_TIME_DAYS",
     14)
+# Connections kept open to bitcoind per process, shared by all threads
+BITCOIND_CONNECTION_POOL_SIZE = getattr(
+    settings,
+    "BITCOIND_CONNECTION_POOL_SIZE",
+    10)
+# Seconds to wait for a bitcoind JSON-RPC response
+BITCOIND_RPC_TIMEOUT = getattr(
+    settings,
+    "BITCOIND_RPC_TIMEOUT",
+    30)
+# Maximum number of calls sent to bitcoind in one JSON-RPC batch request
+BITCOIND_BATCH_SIZE = getattr(
+    settings,
+    "BITCOIND_BATCH_SIZE",
+    500)
+# Network of the bitcoind wallet, 'mainnet', 'testnet' or 'regtest'.
+# When set, addresses of other networks are rejected before they reach
+# sendmany. None accepts the addresses of every known network.
+BITCOIN_NETWORK = getattr(
+    settings,
+    "BITCOIN_NETWORK",
+    None)
 BITCOIN_MINIMUM_CONFIRMATIONS = getattr(
     settings,
     "BITCOIN_MINIMUM_CONFIRMATIONS",
@@ -63,6 +97,13 @@ BITCOIN_UNCONFIRMED_TRANSFERS = getattr(
     "BITCOIN_UNCONFIRMED_TRANSFERS",
     False)
 
+# Aggregate every balance read from the transactions and compare it to the
+# materialized wallet balance. Slow, meant for verifying deployments.
+BITCOIN_LEDGER_VERIFY = getattr(
+    settings,
+    "BITCOIN_LEDGER_VERIFY",
+    False)
+
 BITCOIN_PRIVKEY_FEE = getattr(
     settings,
     "BITCOIN_PRIVKEY_FEE",
@@ -73,6 +114,25 @@ BITCOIN_OPENEXCHANGERATES_URL = getattr(
     "BITCOIN_OPENEXCHANGERATES_URL",
     "http://openexchangerates.org/api/latest.json")
 
+# Seconds an exchange rate read from the cache is reused within a process
+BITCOIN_RATE_LOCAL_CACHE_SECONDS = getattr(
+    settings,
+    "BITCOIN_RATE_LOCAL_CACHE_SECONDS",
+    10)
+
+# Seconds to wait for an exchange rate or market data source
+BITCOIN_RATE_FETCH_TIMEOUT = getattr(
+    settings,
+    "BITCOIN_RATE_FETCH_TIMEOUT",
+    5)
+
+# Refresh expired rates in a background thread and serve the old ones
+# meanwhile, instead of fetching inside the request
+BITCOIN_RATE_BACKGROUND_REFRESH = getattr(
+    settings,
+    "BITCOIN_RATE_BACKGROUND_REFRESH",
+    True)
+
 HISTORICALPRICES_FETCH_TIMESPAN_MINUTES = getattr(
     settings,
     "HISTORICALPRICES_FETCH_TIMESPAN_HOURS",
@@ -83,6 +143,38 @@ BITCOIN_OUTGOING_DEFAULT_DELAY_SECONDS = getattr(
     "BITCOIN_OUTGOING_DEFAULT_DELAY_SECONDS",
     2)
 
+# Outgoing transactions are paid in batches with one sendmany. A batch is
+# sent when this many payments are pending, when one has waited for
+# BITCOIN_OUTGOING_MAX_WAIT_SECONDS, or when one has reached its expires_at.
+BITCOIN_OUTGOING_BATCH_SIZE = getattr(
+    settings,
+    "BITCOIN_OUTGOING_BATCH_SIZE",
+    7)
+
+BITCOIN_OUTGOING_MAX_WAIT_SECONDS = getattr(
+    settings,
+    "BITCOIN_OUTGOING_MAX_WAIT_SECONDS",
+    60)
+
+# Maximum number of distinct addresses paid by one sendmany
+BITCOIN_OUTGOING_MAX_OUTPUTS = getattr(
+    settings,
+    "BITCOIN_OUTGOING_MAX_OUTPUTS",
+    250)
+
+# Wallet.send_to_wallet and send_to_address retry a lost race on the
+# wallet balance this many times, sleeping a random time of up to
+# BITCOIN_TRANSFER_RETRY_BACKOFF * 2 ** retry seconds before each retry
+BITCOIN_TRANSFER_RETRIES = getattr(
+    settings,
+    "BITCOIN_TRANSFER_RETRIES",
+    5)
+
+BITCOIN_TRANSFER_RETRY_BACKOFF = getattr(
+    settings,
+    "BITCOIN_TRANSFER_RETRY_BACKOFF",
+    0.02)
+
 ENABLE_INTERNAL_TRANSACTIONS = getattr(
     settings,
     "ENABLE_INTERNAL_TRANSACTIONS",
@@ -63,8 +63,19 @@ def exchangerates_json():
 
 
 @register.inclusion_tag('wallet_history.html')
-def wallet_history(wallet):
-    return {'wallet': wallet}
+def wallet_history(wallet, page=1, per_page=50):
+    # page usually comes straight from request.GET
+    try:
+        page = max(int(page or 1), 1)
+    except (ValueError, TypeError):
+        page = 1
+    entries = wallet.history(limit=per_page + 1, offset=(page - 1) * per_page)
+    return {'wallet': wallet,
+            'history': entries[:per_page],
+            'page': page,
+            'previous_page': page - 1,
+            'next_page': page + 1,
+            'has_next': len(entries) > per_page}
 
 
 @register.filter
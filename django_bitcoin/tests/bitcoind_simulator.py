@@ -0,0 +1,656 @@
+# vim: tabstop=4 expandtab autoindent shiftwidth=4 fileencoding=utf-8
+"""In-process bitcoind JSON-RPC simulator.
+
+Simulates a regtest-style bitcoind wallet over HTTP JSON-RPC, so code
+using ``BITCOIND_CONNECTION_STRING`` can be tested and load tested
+without a real node:
+
+    simulator = BitcoindSimulator(latency=0.002).start()
+    settings.BITCOIND_CONNECTION_STRING = simulator.connection_string
+    address = simulator.wallet.rpc_getnewaddress()
+    simulator.wallet.deposit(address, Decimal("1.5"))
+    simulator.wallet.generate(6)
+    ...
+    simulator.stop()
+
+Blocks are only mined by ``generate``. Reorgs are simulated with
+``invalidateblock`` or ``reorg``, deposits that are dropped in a reorg
+show up with -1 confirmations like conflicted transactions do. Every
+spend pays ``fee`` plus ``fee_per_output`` for each output.
+
+It can also be run standalone, for benchmarks with several processes:
+
+    python -m django_bitcoin.tests.bitcoind_simulator --port 18443 --fund 100
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+
+from decimal import Decimal
+
+from django_bitcoin.fields.utils import b58encode, b58decode, is_valid_btc_address
+
+SATOSHI = Decimal("0.00000001")
+
+
+class RPCError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+def _amount(value):
+    amount = Decimal(str(value)).quantize(SATOSHI)
+    if amount <= 0:
+        raise RPCError(-3, "Invalid amount")
+    return amount
+
+
+def _random_hash():
+    return hashlib.sha256(os.urandom(32)).hexdigest()
+
+
+def _json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(repr(value) + " is not JSON serializable")
+
+
+class SimulatedWallet(object):
+    """The chain and wallet state. Methods named ``rpc_<method>`` are
+    reachable over JSON-RPC, the rest drive the simulation."""
+
+    def __init__(self, fee=Decimal("0.0001"), fee_per_output=Decimal(0), address_version=0):
+        self.lock = threading.RLock()
+        self.fee = Decimal(fee)
+        self.fee_per_output = Decimal(fee_per_output)
+        self.address_version = address_version
+        self.chain = []
+        self.blocks = {}
+        # hash of a block that was reorganized away -> height of the fork point
+        self.stale = {}
+        self.transactions = {}
+        self.mempool = []
+        self.accounts = {}
+        self.change = set()
+        # (txid, vout) -> {"address", "amount", "spent"}
+        self.outputs = {}
+        self._mine_block([])
+
+    def call(self, method, params):
+        func = getattr(self, "rpc_" + str(method), None)
+        if func is None:
+            raise RPCError(-32601, "Method not found")
+        with self.lock:
+            try:
+                return func(*params)
+            except TypeError as e:
+                raise RPCError(-1, str(e))
+
+    # Simulation
+
+    def new_address(self):
+        h160 = os.urandom(20)
+        vh160 = chr(self.address_version) + h160
+        checksum = hashlib.sha256(hashlib.sha256(vh160).digest()).digest()[:4]
+        return b58encode(vh160 + checksum)
+
+    def generate(self, count=1):
+        """Mines ``count`` blocks, the mempool goes into the first one."""
+        with self.lock:
+            hashes = []
+            for i in range(int(count)):
+                hashes.append(self._mine_block(self.mempool))
+                self.mempool = []
+            return hashes
+
+    def deposit(self, address, amount, confirmations=0):
+        """Sends ``amount`` to ``address`` from outside the wallet."""
+        with self.lock:
+            txid = self._add_transaction([], [(address, _amount(amount))], Decimal(0), False)
+            if confirmations:
+                self.generate(confirmations)
+            return txid
+
+    def reorg(self, depth, new_blocks=None, drop=()):
+        """Replaces the last ``depth`` blocks with ``new_blocks`` (by
+        default ``depth + 1``) others. Transactions in ``drop`` are
+        double spent and don't make it to the new chain."""
+        with self.lock:
+            self.rpc_invalidateblock(self.chain[-int(depth)])
+            for txid in drop:
+                self._conflict(txid)
+            return self.generate(int(depth) + 1 if new_blocks is None else new_blocks)
+
+    def confirmations(self, txid):
+        with self.lock:
+            return self._confirmations(self.transactions[txid])
+
+    # Internals
+
+    def _height(self):
+        return len(self.chain) - 1
+
+    def _mine_block(self, txids):
+        block_hash = _random_hash()
+        height = len(self.chain)
+        self.blocks[block_hash] = {
+            "hash": block_hash,
+            "height": height,
+            "time": int(time.time()),
+            "tx": list(txids),
+            "previousblockhash": self.chain[-1] if self.chain else None,
+        }
+        self.chain.append(block_hash)
+        for txid in txids:
+            self.transactions[txid]["blockhash"] = block_hash
+        return block_hash
+
+    def _confirmations(self, tx):
+        if tx["conflicted"]:
+            return -1
+        if tx["blockhash"] is None:
+            return 0
+        return self._height() - self.blocks[tx["blockhash"]]["height"] + 1
+
+    def _add_transaction(self, inputs, outputs, fee, from_wallet, change=None):
+        txid = _random_hash()
+        for outpoint in inputs:
+            self.outputs[outpoint]["spent"] = txid
+        for vout, (address, amount) in enumerate(outputs):
+            self.outputs[(txid, vout)] = {"address": address, "amount": amount, "spent": None}
+        self.transactions[txid] = {
+            "txid": txid,
+            "inputs": list(inputs),
+            "outputs": list(outputs),
+            "fee": fee,
+            "from_wallet": from_wallet,
+            "change": change,
+            "blockhash": None,
+            "conflicted": False,
+            "time": int(time.time()),
+            "sequence": len(self.transactions),
+        }
+        self.mempool.append(txid)
+        return txid
+
+    def _conflict(self, txid):
+        tx = self.transactions[txid]
+        if tx["blockhash"] is not None:
+            raise RPCError(-5, "Transaction already in block")
+        for vout in range(len(tx["outputs"])):
+            if self.outputs[(txid, vout)]["spent"]:
+                raise RPCError(-5, "Transaction outputs already spent")
+        for outpoint in tx["inputs"]:
+            self.outputs[outpoint]["spent"] = None
+        tx["conflicted"] = True
+        self.mempool.remove(txid)
+
+    def _is_mine(self, address):
+        return address in self.accounts
+
+    def _unspent(self, minconf=1, maxconf=9999999, addresses=None):
+        coins = []
+        for (txid, vout), output in self.outputs.items():
+            if output["spent"] or not self._is_mine(output["address"]):
+                continue
+            if addresses is not None and output["address"] not in addresses:
+                continue
+            tx = self.transactions[txid]
+            confirmations = self._confirmations(tx)
+            # unconfirmed change of our own transactions is spendable
+            trusted = confirmations == 0 and tx["from_wallet"] and minconf <= 1
+            if (minconf <= confirmations <= maxconf) or trusted:
+                coins.append((txid, vout, output, confirmations))
+        coins.sort(key=lambda coin: (-coin[3], coin[0], coin[1]))
+        return coins
+
+    def _spend(self, outputs, minconf=1):
+        fee = self.fee + self.fee_per_output * len(outputs)
+        needed = sum(amount for address, amount in outputs) + fee
+        selected = []
+        total = Decimal(0)
+        for txid, vout, output, confirmations in self._unspent(minconf):
+            if total >= needed:
+                break
+            selected.append((txid, vout))
+            total += output["amount"]
+        if total < needed:
+            raise RPCError(-6, "Insufficient funds")
+        outputs = list(outputs)
+        change = None
+        if total > needed:
+            change_address = self.new_address()
+            self.accounts[change_address] = ""
+            self.change.add(change_address)
+            change = len(outputs)
+            outputs.append((change_address, total - needed))
+        return self._add_transaction(selected, outputs, fee, True, change)
+
+    def _check_address(self, address):
+        if not is_valid_btc_address(address):
+            raise RPCError(-5, "Invalid Bitcoin address: %s" % address)
+
+    def _details(self, tx):
+        details = []
+        if tx["from_wallet"]:
+            for vout, (address, amount) in enumerate(tx["outputs"]):
+                if vout == tx["change"]:
+                    continue
+                details.append({"account": "", "address": address, "category": "send",
+                                "amount": -amount, "vout": vout, "fee": -tx["fee"]})
+        for vout, (address, amount) in enumerate(tx["outputs"]):
+            if vout == tx["change"] or not self._is_mine(address):
+                continue
+            details.append({"account": self.accounts[address], "address": address,
+                            "category": "receive", "amount": amount, "vout": vout})
+        return details
+
+    def _tx_info(self, tx):
+        info = {
+            "txid": tx["txid"],
+            "confirmations": self._confirmations(tx),
+            "time": tx["time"],
+            "timereceived": tx["time"],
+        }
+        if tx["blockhash"] is not None:
+            block = self.blocks[tx["blockhash"]]
+            info["blockhash"] = block["hash"]
+            info["blockindex"] = block["tx"].index(tx["txid"])
+            info["blocktime"] = block["time"]
+        return info
+
+    def _listed(self, txs):
+        entries = []
+        for tx in txs:
+            info = self._tx_info(tx)
+            for detail in self._details(tx):
+                detail.update(info)
+                entries.append(detail)
+        return entries
+
+    def _ordered_transactions(self):
+        return sorted(self.transactions.values(), key=lambda tx: tx["sequence"])
+
+    # Chain
+
+    def rpc_getblockcount(self):
+        return self._height()
+
+    def rpc_getbestblockhash(self):
+        return self.chain[-1]
+
+    def rpc_getblockhash(self, height):
+        if height < 0 or height > self._height():
+            raise RPCError(-8, "Block height out of range")
+        return self.chain[height]
+
+    def rpc_getblock(self, block_hash, verbose=True):
+        if block_hash not in self.blocks:
+            raise RPCError(-5, "Block not found")
+        block = dict(self.blocks[block_hash])
+        if block_hash in self.stale:
+            block["confirmations"] = -1
+        else:
+            block["confirmations"] = self._height() - block["height"] + 1
+        return block
+
+    def rpc_getinfo(self):
+        return {"version": 90000, "blocks": self._height(), "balance": self.rpc_getbalance(),
+                "testnet": False, "errors": ""}
+
+    def rpc_generate(self, count, maxtries=None):
+        return self.generate(count)
+
+    def rpc_invalidateblock(self, block_hash):
+        if block_hash not in self.blocks:
+            raise RPCError(-5, "Block not found")
+        if block_hash in self.stale:
+            return None
+        height = self.blocks[block_hash]["height"]
+        removed = self.chain[height:]
+        self.chain = self.chain[:height]
+        for stale_hash, fork in self.stale.items():
+            self.stale[stale_hash] = min(fork, height - 1)
+        readded = []
+        for removed_hash in removed:
+            self.stale[removed_hash] = height - 1
+            readded += self.blocks[removed_hash]["tx"]
+        for txid in readded:
+            self.transactions[txid]["blockhash"] = None
+        self.mempool = readded + self.mempool
+        return None
+
+    # Wallet
+
+    def rpc_getnewaddress(self, account=""):
+        address = self.new_address()
+        self.accounts[address] = account
+        return address
+
+    def rpc_validateaddress(self, address):
+        if not is_valid_btc_address(address):
+            return {"isvalid": False}
+        return {"isvalid": True, "address": address, "ismine": self._is_mine(address),
+                "account": self.accounts.get(address)}
+
+    def rpc_importprivkey(self, key, label="", rescan=True):
+        # pywallet is slow to import and noisy, only load it when needed
+        from django_bitcoin.pywallet import privkey2address
+        address = privkey2address(key)
+        if not address:
+            raise RPCError(-5, "Invalid private key encoding")
+        self.accounts.setdefault(address, label)
+        return None
+
+    def rpc_getbalance(self, account=None, minconf=1):
+        return sum((output["amount"] for txid, vout, output, confirmations
+                    in self._unspent(minconf)), Decimal(0))
+
+    def rpc_getreceivedbyaddress(self, address, minconf=1):
+        self._check_address(address)
+        total = Decimal(0)
+        for (txid, vout), output in self.outputs.items():
+            if output["address"] == address and \
+                    self._confirmations(self.transactions[txid]) >= minconf:
+                total += output["amount"]
+        return total
+
+    def rpc_listreceivedbyaddress(self, minconf=1, include_empty=False):
+        received = {}
+        for (txid, vout), output in self.outputs.items():
+            address = output["address"]
+            if not self._is_mine(address) or address in self.change:
+                continue
+            confirmations = self._confirmations(self.transactions[txid])
+            if confirmations < minconf:
+                continue
+            entry = received.setdefault(address, {"address": address, "account": self.accounts[address],
+                                                  "amount": Decimal(0), "confirmations": confirmations,
+                                                  "txids": []})
+            entry["amount"] += output["amount"]
+            entry["confirmations"] = min(entry["confirmations"], confirmations)
+            entry["txids"].append(txid)
+        if include_empty:
+            for address, account in self.accounts.items():
+                if address not in received and address not in self.change:
+                    received[address] = {"address": address, "account": account, "amount": Decimal(0),
+                                         "confirmations": 0, "txids": []}
+        return received.values()
+
+    def rpc_listtransactions(self, account="*", count=10, skip=0):
+        entries = self._listed(self._ordered_transactions())
+        if account != "*":
+            entries = [entry for entry in entries if entry["account"] == account]
+        end = len(entries) - skip
+        return entries[max(end - count, 0):max(end, 0)]
+
+    def rpc_listsinceblock(self, block_hash=None, target_confirmations=1):
+        if not block_hash:
+            since = -1
+        elif block_hash in self.stale:
+            since = self.stale[block_hash]
+        elif block_hash in self.blocks:
+            since = self.blocks[block_hash]["height"]
+        else:
+            raise RPCError(-5, "Block not found")
+        txs = []
+        for tx in self._ordered_transactions():
+            if tx["conflicted"] or tx["blockhash"] is None or \
+                    self.blocks[tx["blockhash"]]["height"] > since:
+                txs.append(tx)
+        last = max(self._height() + 1 - target_confirmations, 0)
+        return {"transactions": self._listed(txs), "lastblock": self.chain[last]}
+
+    def rpc_gettransaction(self, txid):
+        if txid not in self.transactions:
+            raise RPCError(-5, "Invalid or non-wallet transaction id")
+        tx = self.transactions[txid]
+        details = self._details(tx)
+        info = self._tx_info(tx)
+        info["amount"] = sum((detail["amount"] for detail in details), Decimal(0))
+        if tx["from_wallet"]:
+            info["fee"] = -tx["fee"]
+        info["details"] = details
+        return info
+
+    def rpc_listunspent(self, minconf=1, maxconf=9999999, addresses=None):
+        unspent = []
+        for txid, vout, output, confirmations in self._unspent(minconf, maxconf, addresses):
+            h160 = b58decode(output["address"], 25)
+            unspent.append({
+                "txid": txid,
+                "vout": vout,
+                "address": output["address"],
+                "account": self.accounts[output["address"]],
+                "scriptPubKey": "76a914" + h160[1:21].encode("hex") + "88ac" if h160 else "",
+                "amount": output["amount"],
+                "confirmations": confirmations,
+                "spendable": True,
+            })
+        return unspent
+
+    def rpc_sendtoaddress(self, address, amount, comment="", comment_to=""):
+        self._check_address(address)
+        return self._spend([(address, _amount(amount))])
+
+    def rpc_sendmany(self, account, amounts, minconf=1, comment=""):
+        if not amounts:
+            raise RPCError(-6, "Transaction amounts must be positive")
+        outputs = []
+        for address, amount in amounts.items():
+            self._check_address(address)
+            outputs.append((address, _amount(amount)))
+        return self._spend(outputs, minconf)
+
+    # Raw transactions, encoded as hex of JSON instead of the wire format
+
+    def rpc_createrawtransaction(self, inputs, outputs):
+        for address, amount in outputs.items():
+            self._check_address(address)
+            _amount(amount)
+        return json.dumps({
+            "vin": [{"txid": i["txid"], "vout": i["vout"]} for i in inputs],
+            "vout": [[address, str(amount)] for address, amount in outputs.items()],
+        }).encode("hex")
+
+    def rpc_decoderawtransaction(self, hex_string):
+        try:
+            return json.loads(hex_string.decode("hex"))
+        except (TypeError, ValueError):
+            raise RPCError(-22, "TX decode failed")
+
+    def rpc_signrawtransaction(self, hex_string, prevtxs=None, keys=None):
+        self.rpc_decoderawtransaction(hex_string)
+        return {"hex": hex_string, "complete": True}
+
+    def rpc_sendrawtransaction(self, hex_string, allowhighfees=False):
+        raw = self.rpc_decoderawtransaction(hex_string)
+        inputs = [(i["txid"], i["vout"]) for i in raw["vin"]]
+        outputs = [(address, _amount(amount)) for address, amount in raw["vout"]]
+        total_in = Decimal(0)
+        for outpoint in inputs:
+            output = self.outputs.get(outpoint)
+            if output is None or output["spent"] or self.transactions[outpoint[0]]["conflicted"]:
+                raise RPCError(-25, "Missing inputs")
+            total_in += output["amount"]
+        fee = total_in - sum(amount for address, amount in outputs)
+        if fee < 0:
+            raise RPCError(-26, "bad-txns-in-belowout")
+        from_wallet = any(self._is_mine(self.outputs[outpoint]["address"]) for outpoint in inputs)
+        return self._add_transaction(inputs, outputs, fee, from_wallet)
+
+
+class _RPCHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive, like bitcoind, so the connection pool gets exercised
+    protocol_version = "HTTP/1.1"
+    # send the headers and body of a response in one segment, separate
+    # small writes stall on Nagle and delayed ACKs for ~40ms per call
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        body = self.rfile.read(int(self.headers.getheader("content-length") or 0))
+        if self.headers.getheader("authorization") != simulator.authorization:
+            return self._respond(401, "")
+        if simulator.latency:
+            time.sleep(simulator.latency)
+        try:
+            request = json.loads(body, parse_float=Decimal)
+        except ValueError:
+            return self._respond(500, self._error(None, -32700, "Parse error"))
+        if isinstance(request, list):
+            if not request:
+                return self._respond(500, self._error(None, -32600, "Invalid Request object"))
+            return self._respond(200, [self._call(r) for r in request])
+        response = self._call(request)
+        return self._respond(500 if response["error"] else 200, response)
+
+    def _call(self, request):
+        if not isinstance(request, dict) or "method" not in request:
+            return self._error(None, -32600, "Invalid Request object")
+        try:
+            result = self.server.simulator.wallet.call(request["method"], request.get("params") or [])
+        except RPCError as e:
+            return self._error(request.get("id"), e.code, e.message)
+        return {"result": result, "error": None, "id": request.get("id")}
+
+    def _error(self, request_id, code, message):
+        return {"result": None, "error": {"code": code, "message": message}, "id": request_id}
+
+    def _respond(self, status, response):
+        data = json.dumps(response, default=_json_default) if response != "" else ""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _RPCServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, *args, **kwargs):
+        BaseHTTPServer.HTTPServer.__init__(self, *args, **kwargs)
+        self.clients = set()
+        self.clients_lock = threading.Lock()
+        self.closing = False
+
+    def process_request_thread(self, request, client_address):
+        with self.clients_lock:
+            self.clients.add(request)
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            with self.clients_lock:
+                self.clients.discard(request)
+
+    def handle_error(self, request, client_address):
+        # keep-alive handlers fail reading from the sockets closed by stop()
+        if not self.closing:
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+    def close_clients(self):
+        """Closes the keep-alive connections, so their handler threads
+        end."""
+        self.closing = True
+        with self.clients_lock:
+            clients = list(self.clients)
+        for request in clients:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            request.close()
+
+
+class BitcoindSimulator(object):
+    """Serves a ``SimulatedWallet`` over HTTP. ``latency`` seconds are
+    added to every HTTP request, a batch counts as one request."""
+
+    def __init__(self, host="127.0.0.1", port=0, user="bitcoinrpc", password="simulator",
+                 latency=0, wallet=None, **wallet_kwargs):
+        self.wallet = wallet or SimulatedWallet(**wallet_kwargs)
+        self.latency = latency
+        self.user = user
+        self.password = password
+        self.authorization = "Basic %s" % base64.b64encode("%s:%s" % (user, password))
+        self.server = _RPCServer((host, port), _RPCHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def connection_string(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%s@%s:%d" % (self.user, self.password, host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.close_clients()
+        self.thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=18443)
+    parser.add_option("--user", default="bitcoinrpc")
+    parser.add_option("--password", default="simulator")
+    parser.add_option("--latency", type="float", default=0,
+                      help="seconds added to every request")
+    parser.add_option("--fee", default="0.0001", help="fee per transaction")
+    parser.add_option("--fee-per-output", default="0", help="fee per transaction output")
+    parser.add_option("--fund", default="0", help="deposit this much to the wallet at start")
+    parser.add_option("--block-interval", type="float", default=0,
+                      help="mine a block every this many seconds")
+    options, args = parser.parse_args()
+
+    simulator = BitcoindSimulator(options.host, options.port, options.user, options.password,
+                                  options.latency, fee=Decimal(options.fee),
+                                  fee_per_output=Decimal(options.fee_per_output))
+    wallet = simulator.wallet
+    if Decimal(options.fund) > 0:
+        wallet.deposit(wallet.rpc_getnewaddress(), Decimal(options.fund), confirmations=1)
+    simulator.start()
+    print simulator.connection_string
+    try:
+        while True:
+            if options.block_interval:
+                time.sleep(options.block_interval)
+                wallet.generate(1)
+            else:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()
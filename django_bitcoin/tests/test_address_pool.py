@@ -0,0 +1,37 @@
+from django.db import connection
+from django.test import TransactionTestCase
+
+import mock
+
+from django_bitcoin import models
+from django_bitcoin.models import BitcoinAddress
+
+
+@mock.patch('django_bitcoin.models.schedule_payment_queue_refill')
+class AddressPoolTest(TransactionTestCase):
+    def setUp(self):
+        self.free = [BitcoinAddress.objects.create(address="pool-test-%d" % i) for i in range(2)]
+        BitcoinAddress.objects.create(address="pool-test-used", least_received=1)
+
+    def test_skip_locked_version(self, schedule):
+        self.assertTrue(models.skip_locked_version_ok('postgresql', '90500'))
+        self.assertFalse(models.skip_locked_version_ok('postgresql', '90412'))
+        self.assertTrue(models.skip_locked_version_ok('mysql', '8.0.32-0ubuntu0.22.04.2'))
+        self.assertFalse(models.skip_locked_version_ok('mysql', '5.7.40-log'))
+        self.assertTrue(models.skip_locked_version_ok('mysql', '10.6.12-MariaDB-0ubuntu0.22.04.1'))
+        self.assertFalse(models.skip_locked_version_ok('mysql', '10.5.18-MariaDB'))
+        self.assertFalse(models.skip_locked_version_ok('sqlite', '3.40.1'))
+
+    def test_optimistic_allocation(self, schedule):
+        with mock.patch('django_bitcoin.models.skip_locked_supported', return_value=False):
+            addresses = [models.new_bitcoin_address() for i in range(2)]
+        self.assertEquals([a.id for a in addresses], [a.id for a in self.free])
+        self.assertEquals(BitcoinAddress.objects.filter(active=True).count(), 2)
+
+    def test_skip_locked_allocation(self, schedule):
+        if not models.skip_locked_supported(connection):
+            self.skipTest("database without SKIP LOCKED")
+        addresses = [models.new_bitcoin_address() for i in range(2)]
+        self.assertEquals([a.id for a in addresses], [a.id for a in self.free])
+        self.assertEquals(BitcoinAddress.objects.filter(active=True).count(), 2)
+        self.assertEquals(models.claim_free_address(), None)
@@ -0,0 +1,91 @@
+from django.test import SimpleTestCase
+
+from django_bitcoin.fields import utils
+
+
+class ValidateAddressesTest(SimpleTestCase):
+    lines = [
+        "1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2\n",
+        "3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy",
+        "1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN3",
+        "1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN0",
+        "1BvBMSEYst",
+        "LVg2kJoFNg45Nbpy53h7Fe1wKyeXVRhMH9",
+    ]
+
+    def test_reasons(self):
+        results = list(utils.validate_addresses(self.lines))
+        self.assertEquals([(r.line, r.parsed and r.parsed.version, r.error) for r in results], [
+            (1, 0, None),
+            (2, 5, None),
+            (3, None, utils.BAD_CHECKSUM),
+            (4, None, utils.BAD_CHARSET),
+            (5, None, utils.BAD_LENGTH),
+            (6, None, utils.UNKNOWN_VERSION),
+        ])
+        self.assertEquals(results[0].address, "1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2")
+
+    def test_parse_address(self):
+        parsed = utils.parse_address("3J98t1WpEZ73CNmQviecrnyiWrnqRhWNLy")
+        self.assertEquals((parsed.kind, parsed.network, parsed.version), ("p2sh", "mainnet", 5))
+        parsed = utils.parse_address("BC1QW508D6QEJXTDG4Y5R3ZARVARY0C5XW7KV8F3T4")
+        self.assertEquals((parsed.kind, parsed.network, parsed.version), ("witness", "mainnet", 0))
+        self.assertEquals(parsed.program.encode("hex"), "751e76e8199196d454941c45d1b3a323f1433bd6")
+        parsed = utils.parse_address("bc1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vqzk5jj0")
+        self.assertEquals((parsed.network, parsed.version, len(parsed.program)), ("mainnet", 1, 32))
+
+    def test_bech32_errors(self):
+        # bech32m checksum on a version 0 program and the other way around
+        self.assertEquals(utils.check_address("bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kemeawh")[1],
+                          utils.BAD_CHECKSUM)
+        self.assertEquals(utils.check_address("bc1zw508d6qejxtdg4y5r3zarvaryvqyzf3du")[1],
+                          utils.BAD_CHECKSUM)
+        self.assertEquals(utils.check_address("tb1p0xlxvlhemja6c4dqv22uapctqupfhlxm9h8z3k2e72q4k9hcz7vq47Zagq")[1],
+                          utils.BAD_CHARSET)
+        self.assertEquals(utils.check_address("bc1pw5dgrnzv")[1], utils.BAD_LENGTH)
+
+    def test_wrong_network(self):
+        mainnet = ["1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2", "bc1qw508d6qejxtdg4y5r3zarvary0c5xw7kv8f3t4"]
+        testnet = ["mipcBbFg9gMiCh81Kj8tqqdgoZub1ZJRfn", "2MzQwSSnBHWHqSAqtTVQ6v47XtaisrJa1Vc",
+                   "tb1qw508d6qejxtdg4y5r3zarvary0c5xw7kxpjzsx"]
+        regtest = ["bcrt1qs758ursh4q9z627kt3pp5yysm78ddny6txaqgw"]
+        for address in testnet + regtest:
+            self.assertEquals(utils.check_address(address, 'mainnet'), (None, utils.WRONG_NETWORK))
+            self.assertEquals(utils.parse_address(address, 'mainnet'), None)
+            self.assertFalse(utils.is_valid_btc_address(address, 'mainnet'))
+        for address in mainnet + regtest:
+            self.assertEquals(utils.check_address(address, 'testnet')[1], utils.WRONG_NETWORK)
+        for address in mainnet:
+            self.assertEquals(utils.check_address(address, 'mainnet')[1], None)
+            self.assertEquals(utils.check_address(address, 'regtest')[1], utils.WRONG_NETWORK)
+        # regtest shares the base58 version bytes of testnet
+        for address in testnet[:2] + regtest:
+            self.assertEquals(utils.check_address(address, 'regtest')[1], None)
+        self.assertEquals(utils.check_address(testnet[2], 'regtest')[1], utils.WRONG_NETWORK)
+        results = list(utils.validate_addresses(mainnet + testnet, network='mainnet'))
+        self.assertEquals([r.error for r in results], [None, None] + [utils.WRONG_NETWORK] * 3)
+
+    def test_process_pool_keeps_order(self):
+        lines = self.lines * 50
+        self.assertEquals(list(utils.validate_addresses(lines, processes=2, chunk_size=7)),
+                          list(utils.validate_addresses(lines)))
+        self.assertEquals(list(utils.validate_addresses(lines, processes=2, chunk_size=7, network='testnet')),
+                          list(utils.validate_addresses(lines, network='testnet')))
+
+    def test_process_pool_reads_ahead_boundedly(self):
+        consumed = []
+
+        def lines():
+            for i in range(10000):
+                consumed.append(i)
+                yield self.lines[i % len(self.lines)]
+        results = utils.validate_addresses(lines(), processes=2, chunk_size=10)
+        next(results)
+        # four chunks in flight, one more submitted for the consumed one
+        self.assertTrue(len(consumed) <= 5 * 10, len(consumed))
+        results.close()
+
+    def test_base58_roundtrip(self):
+        data = "\0\0\x01\x02\xff" * 5
+        self.assertEquals(utils.b58decode(utils.b58encode(data), len(data)), data)
+        self.assertEquals(utils.b58decode("0OIl", None), None)
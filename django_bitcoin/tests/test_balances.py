@@ -0,0 +1,61 @@
+from decimal import Decimal
+from django.test import TestCase
+
+import mock
+
+from django_bitcoin.models import BitcoinAddress, Wallet, WalletTransaction
+
+
+class WalletBalancesTest(TestCase):
+    def setUp(self):
+        self.w1 = Wallet.objects.create()
+        self.w2 = Wallet.objects.create()
+        self.w3 = Wallet.objects.create()
+        BitcoinAddress.objects.create(address="balances-test-1", wallet=self.w1, migrated_to_transactions=False,
+                                      least_received=Decimal("2"), least_received_confirmed=Decimal("1.5"))
+        WalletTransaction.objects.create(from_wallet=self.w1, to_wallet=self.w2, amount=Decimal("0.3"))
+        WalletTransaction.objects.create(from_wallet=self.w2, to_wallet=self.w3, amount=Decimal("0.1"))
+
+    def test_balances(self):
+        ids = [self.w1.id, self.w2.id, self.w3.id]
+        self.assertEquals(Wallet.objects.balances(ids),
+                          {self.w1.id: Decimal("1.2"), self.w2.id: Decimal("0.2"), self.w3.id: Decimal("0.1")})
+        self.assertEquals(Wallet.objects.balances(ids, confirmed=False)[self.w1.id], Decimal("1.7"))
+        self.assertEquals(Wallet.objects.balances()[self.w1.id], self.w1.total_balance_sql())
+
+    def test_iter_balances_chunks(self):
+        empty = Wallet.objects.create()
+        balances = list(Wallet.objects.iter_balances(chunk_size=2))
+        self.assertEquals([wallet_id for wallet_id, balance in balances],
+                          list(Wallet.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEquals(dict(balances)[empty.id], Decimal(0))
+
+    def test_statement(self):
+        entries, cursor = self.w1.statement()
+        # the unmigrated deposit is the opening balance
+        self.assertEquals([e['balance'] for e in entries], [Decimal("1.2")])
+        self.assertEquals(cursor, None)
+        WalletTransaction.objects.create(from_wallet=self.w1, to_wallet=self.w2, amount=Decimal("0.2"))
+        balances = []
+        cursor = None
+        while True:
+            entries, cursor = self.w1.statement(cursor, limit=1)
+            balances += [e['balance'] for e in entries]
+            if cursor is None:
+                break
+            first_cursor = cursor
+        self.assertEquals(balances, [Decimal("1.2"), Decimal("1.0")])
+        self.assertEquals(balances[-1], self.w1.total_balance_sql())
+        # forged, tampered and other wallets' cursors are refused
+        self.assertRaises(ValueError, self.w1.statement, "garbage|1|100")
+        self.assertRaises(ValueError, self.w1.statement, first_cursor[:-1] + "x")
+        self.assertRaises(ValueError, self.w2.statement, first_cursor)
+
+    def test_fix_last_balances(self):
+        from django.core.management import call_command
+        Wallet.objects.filter(id=self.w2.id).update(last_balance=Decimal(5))
+        with mock.patch('django_bitcoin.settings.BITCOIN_UNCONFIRMED_TRANSFERS', True):
+            call_command('FixLastBalancesConcurrency', chunk_size=2)
+        self.assertEquals(dict(Wallet.objects.filter(id__in=[self.w1.id, self.w2.id, self.w3.id])
+                               .values_list('id', 'last_balance')),
+                          {self.w1.id: Decimal("1.2"), self.w2.id: Decimal("0.2"), self.w3.id: Decimal("0.1")})
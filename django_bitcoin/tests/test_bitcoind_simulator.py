@@ -0,0 +1,46 @@
+from decimal import Decimal
+from django.test import SimpleTestCase
+
+from django_bitcoin.bitcoind import BitcoindConnection
+
+from .bitcoind_simulator import BitcoindSimulator
+
+
+class BitcoindSimulatorTest(SimpleTestCase):
+    def setUp(self):
+        self.simulator = BitcoindSimulator().start()
+        self.wallet = self.simulator.wallet
+        self.bitcoind = BitcoindConnection(self.simulator.connection_string, "")
+
+    def tearDown(self):
+        self.simulator.stop()
+
+    def test_deposit_confirmations(self):
+        address, other = self.bitcoind.create_addresses(2)
+        self.wallet.deposit(address, Decimal("1.5"))
+        self.assertEquals(self.bitcoind.total_received([address, other], minconf=0),
+                          {address: Decimal("1.5"), other: Decimal(0)})
+        self.assertEquals(self.bitcoind.total_received(address, minconf=1), Decimal(0))
+        self.wallet.generate(1)
+        self.assertEquals(self.bitcoind.total_received(address, minconf=1), Decimal("1.5"))
+
+    def test_sendmany_fee(self):
+        self.wallet.deposit(self.bitcoind.create_address(), Decimal("1"), confirmations=1)
+        txid = self.bitcoind.sendmany({self.wallet.new_address(): 0.25, self.wallet.new_address(): 0.5})
+        transaction = self.bitcoind.gettransaction(txid)
+        self.assertEquals(transaction["fee"], -self.wallet.fee)
+        self.assertEquals(transaction["amount"], Decimal("-0.75"))
+        self.assertEquals(self.bitcoind.bitcoind_api.getbalance("*", 0),
+                          Decimal("0.25") - self.wallet.fee)
+
+    def test_listsinceblock_reorg(self):
+        address = self.bitcoind.create_address()
+        self.wallet.generate(1)
+        since = self.bitcoind.bitcoind_api.getbestblockhash()
+        kept = self.wallet.deposit(address, Decimal("1"), confirmations=1)
+        dropped = self.wallet.deposit(address, Decimal("2"), confirmations=1)
+        self.wallet.reorg(2, drop=[dropped])
+        transactions = dict((tx["txid"], tx["confirmations"]) for tx
+                            in self.bitcoind.bitcoind_api.listsinceblock(since)["transactions"])
+        self.assertEquals(transactions, {kept: 3, dropped: -1})
+        self.assertEquals(self.bitcoind.total_received(address, minconf=0), Decimal("1"))
@@ -0,0 +1,31 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+import mock
+
+from django_bitcoin import currency
+
+
+class CachedUpstreamTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_cold_start_waiter_doesnt_fetch(self):
+        # another worker holds the refresh flag and never delivers
+        cache.add("test_rate_refreshing", True, 60)
+        fetch = mock.Mock(return_value=1)
+        with mock.patch('django_bitcoin.currency.wait_for_refresh', return_value=None):
+            self.assertRaises(currency.TemporaryConversionError, currency.cached_upstream,
+                              "test_rate", fetch, 60, currency.TemporaryConversionError())
+        self.assertFalse(fetch.called)
+
+    def test_cold_start_waiter_gets_refreshed_value(self):
+        cache.add("test_rate_refreshing", True, 60)
+        fetch = mock.Mock(return_value=1)
+        with mock.patch('django_bitcoin.currency.wait_for_refresh', return_value=2):
+            self.assertEquals(currency.cached_upstream("test_rate", fetch, 60,
+                                                       currency.TemporaryConversionError()), 2)
+        self.assertFalse(fetch.called)
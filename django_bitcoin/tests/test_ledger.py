@@ -0,0 +1,72 @@
+from decimal import Decimal
+from django.test import TestCase
+
+import mock
+
+from django_bitcoin.models import BitcoinAddress, DepositTransaction, Wallet, WalletTransaction
+
+
+class WalletLedgerTest(TestCase):
+    def setUp(self):
+        self.w1 = Wallet.objects.create()
+        self.w2 = Wallet.objects.create()
+        self.fee_wallet = Wallet.objects.create()
+        self.unmigrated = BitcoinAddress.objects.create(address="ledger-test-1", wallet=self.w1, active=True,
+                                                        migrated_to_transactions=False)
+        self.migrated = BitcoinAddress.objects.create(address="ledger-test-2", wallet=self.w2, active=True)
+
+    def assertLedger(self, *wallets):
+        for wallet in wallets:
+            wallet = Wallet.objects.get(id=wallet.id)
+            self.assertEquals((wallet.balance_confirmed, wallet.balance_unconfirmed),
+                              (wallet.total_balance_sql(True), wallet.total_balance_sql(False)))
+
+    def deposit(self, address, amount):
+        address.query_unconfirmed_deposits(received=address.least_received + amount)
+        deposit = DepositTransaction.objects.create(address=address, wallet=address.wallet, amount=amount)
+        with mock.patch('django_bitcoin.models.bitcoind') as bitcoind:
+            bitcoind.total_received.return_value = address.least_received_confirmed + amount
+            address.query_bitcoin_deposit(deposit)
+
+    def test_deposits_transfers_fees(self):
+        self.unmigrated.query_unconfirmed_deposits(received=Decimal("1"))
+        self.assertEquals(Wallet.objects.get(id=self.w1.id).balance_unconfirmed, Decimal("1"))
+        self.assertLedger(self.w1)
+        self.deposit(self.unmigrated, Decimal("1"))
+        self.deposit(self.migrated, Decimal("0.5"))
+        self.assertEquals(Wallet.objects.get(id=self.w2.id).balance_confirmed, Decimal("0.5"))
+        self.assertLedger(self.w1, self.w2)
+
+        WalletTransaction.objects.create(from_wallet=self.w1, to_wallet=self.w2, amount=Decimal("0.3"))
+        WalletTransaction.objects.create(from_wallet=self.w2, to_bitcoinaddress="1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2",
+                                         amount=Decimal("0.2"))
+        # a sendmany fee, booked to the fee wallet and paid out of it
+        WalletTransaction.objects.create(from_wallet=self.w2, to_wallet=self.fee_wallet, amount=Decimal("0.001"))
+        WalletTransaction.objects.create(from_wallet=self.fee_wallet, to_wallet=None, amount=Decimal("0.001"))
+        self.assertEquals(Wallet.objects.get(id=self.w2.id).balance_confirmed, Decimal("0.599"))
+        self.assertLedger(self.w1, self.w2, self.fee_wallet)
+
+    def test_merge_wallet(self):
+        self.deposit(self.unmigrated, Decimal("1"))
+        self.deposit(self.migrated, Decimal("0.5"))
+        WalletTransaction.objects.create(from_wallet=self.w1, to_wallet=self.w2, amount=Decimal("0.3"))
+        self.w1.merge_wallet(self.w2)
+        w1 = Wallet.objects.get(id=self.w1.id)
+        self.assertEquals((w1.balance_confirmed, w1.balance_unconfirmed), (Decimal(0), Decimal(0)))
+        self.assertEquals(Wallet.objects.get(id=self.w2.id).balance_confirmed, Decimal("1.5"))
+        self.assertLedger(self.w1, self.w2)
+
+    def test_rebuild_ledger_balance(self):
+        self.deposit(self.unmigrated, Decimal("1"))
+        Wallet.objects.filter(id=self.w1.id).update(balance_confirmed=Decimal(7), balance_unconfirmed=Decimal(7))
+        self.w1.rebuild_ledger_balance()
+        self.assertEquals(self.w1.balance_confirmed, Decimal("1"))
+        self.assertLedger(self.w1)
+
+    def test_integrity_check(self):
+        from django_bitcoin.integrity import check_integrity
+        self.deposit(self.unmigrated, Decimal("1"))
+        WalletTransaction.objects.create(from_wallet=self.w1, to_wallet=self.w2, amount=Decimal("0.3"))
+        # w2's last_balance was never refreshed and stays 0, w1's is stale
+        self.assertEquals(check_integrity()['wallets'],
+                          [(self.w1.id, Decimal("1"), Decimal("0.7"), Decimal("0.7"))])
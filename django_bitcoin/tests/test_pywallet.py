@@ -0,0 +1,36 @@
+from django.test import SimpleTestCase
+
+from django_bitcoin import pywallet
+
+
+class PrivkeysToAddressesTest(SimpleTestCase):
+    keys = [
+        "5HueCGU8rMjxEXxiPuD5BDku4MkFqeZyd4dZ1jvhTVqvbTLvyTJ",
+        "notakey",
+        "KwdMAjGmerYanjeui5SHS7JkmpZvVipYvB2LJGU1ZxJwYvP98617",
+    ]
+    addresses = [
+        "1GAehh7TsJAHuUAeKZcXf5CnwuGuGgyX2S",
+        None,
+        "1LoVGDgRs9hTfTNJNuXKSpywcbdvwRXpmK",
+    ]
+
+    def test_in_order(self):
+        self.assertEquals(list(pywallet.privkeys2addresses(self.keys)), self.addresses)
+        self.assertEquals(pywallet.privkey2address(self.keys[0]), self.addresses[0])
+
+    def test_workers(self):
+        self.assertEquals(list(pywallet.privkeys2addresses(self.keys * 3, workers=2, chunk_size=2)),
+                          self.addresses * 3)
+
+    def test_workers_read_ahead_boundedly(self):
+        consumed = []
+
+        def keys():
+            for i in range(1000):
+                consumed.append(i)
+                yield self.keys[i % len(self.keys)]
+        addresses = pywallet.privkeys2addresses(keys(), workers=2, chunk_size=3)
+        self.assertEquals(next(addresses), self.addresses[0])
+        self.assertTrue(len(consumed) <= 5 * 3, len(consumed))
+        addresses.close()
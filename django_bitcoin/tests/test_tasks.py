@@ -0,0 +1,62 @@
+from decimal import Decimal
+from django.core.cache import cache
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+import mock
+
+from django_bitcoin import tasks
+from django_bitcoin.bitcoind import BitcoindConnection
+from django_bitcoin.models import BitcoinAddress, DepositTransaction, OutgoingTransaction, Wallet, WalletTransaction
+from django_bitcoin.utils import fee_wallet
+
+from .bitcoind_simulator import BitcoindSimulator
+
+
+class SimulatorTasksTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.simulator = BitcoindSimulator().start()
+        self.bitcoind = BitcoindConnection(self.simulator.connection_string, "")
+        patchers = [mock.patch('django_bitcoin.tasks.bitcoind', self.bitcoind),
+                    mock.patch('django_bitcoin.models.bitcoind', self.bitcoind)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.simulator.wallet.generate(110)
+        self.wallet = Wallet.objects.create()
+
+    def tearDown(self):
+        self.simulator.stop()
+        cache.clear()
+
+    def test_query_transactions(self):
+        address = BitcoinAddress.objects.create(address=self.bitcoind.create_address(), wallet=self.wallet,
+                                                active=True)
+        txid = self.simulator.wallet.deposit(address.address, Decimal("1.5"), confirmations=3)
+        tasks.query_transactions()
+        deposit = DepositTransaction.objects.get(txid=txid)
+        self.assertEquals((deposit.address_id, deposit.amount), (address.id, Decimal("1.5")))
+        self.assertNotEqual(deposit.transaction, None)
+        self.assertEquals(Wallet.objects.get(id=self.wallet.id).balance_confirmed, Decimal("1.5"))
+        # a second run finds the deposit already booked
+        tasks.query_transactions()
+        self.assertEquals(WalletTransaction.objects.filter(deposit_address=address).count(), 1)
+
+    def test_process_outgoing_transactions(self):
+        self.simulator.wallet.deposit(self.bitcoind.create_address(), Decimal("2"), confirmations=1)
+        to_address = self.simulator.wallet.new_address()
+        ot = OutgoingTransaction.objects.create(amount=Decimal("0.5"), to_bitcoinaddress=to_address,
+                                                expires_at=timezone.now())
+        WalletTransaction.objects.create(amount=Decimal("0.5"), from_wallet=self.wallet,
+                                         to_bitcoinaddress=to_address, outgoing_transaction=ot)
+        with mock.patch('django_bitcoin.tasks.update_wallet_balances') as update_wallet_balances:
+            tasks.process_outgoing_transactions()
+        update_wallet_balances.delay.assert_called_once_with([self.wallet.id])
+        ot = OutgoingTransaction.objects.get(id=ot.id)
+        self.assertNotEqual(ot.executed_at, None)
+        transaction = self.bitcoind.gettransaction(ot.txid)
+        self.assertEquals(transaction["amount"], Decimal("-0.5"))
+        fee = -Decimal(transaction["fee"])
+        self.assertEquals(Wallet.objects.get(id=self.wallet.id).balance_confirmed, -Decimal("0.5") - fee)
+        self.assertEquals(WalletTransaction.objects.get(from_wallet=fee_wallet(), to_wallet=None).amount, fee)
@@ -0,0 +1,40 @@
+from decimal import Decimal
+from django.test import SimpleTestCase
+
+from django_bitcoin import utils
+
+
+class PlanOutgoingBatchTest(SimpleTestCase):
+    def test_merges_same_address(self):
+        ids, outputs = utils.plan_outgoing_batch([
+            (1, "addr1", Decimal("0.1")),
+            (2, "addr2", Decimal("0.2")),
+            (3, "addr1", Decimal("0.30000001")),
+        ], 10)
+        self.assertEquals(ids, [1, 2, 3])
+        self.assertEquals(outputs, {"addr1": 0.40000001, "addr2": 0.2})
+
+    def test_max_outputs(self):
+        ids, outputs = utils.plan_outgoing_batch([
+            (1, "addr1", Decimal("1")),
+            (2, "addr2", Decimal("1")),
+            (3, "addr1", Decimal("1")),
+            (4, "addr3", Decimal("1")),
+            (5, "addr2", Decimal("1")),
+        ], 2)
+        self.assertEquals(ids, [1, 2, 3])
+        self.assertEquals(outputs, {"addr1": 2.0, "addr2": 1.0})
+
+    def test_empty(self):
+        self.assertEquals(utils.plan_outgoing_batch([], 5), ([], {}))
+
+
+class SplitAmountTest(SimpleTestCase):
+    def test_exact_sum(self):
+        parts = utils.split_amount(Decimal("0.0001"), 3)
+        self.assertEquals(parts, [Decimal("0.00003334"), Decimal("0.00003333"), Decimal("0.00003333")])
+        self.assertEquals(sum(parts), Decimal("0.0001"))
+
+    def test_fewer_satoshis_than_parts(self):
+        parts = utils.split_amount(Decimal("0.00000002"), 4)
+        self.assertEquals(parts, [Decimal("0.00000001"), Decimal("0.00000001"), Decimal(0), Decimal(0)])
@@ -13,6 +13,25 @@ def decimal_float(d):
     return float(d.quantize(decimal.Decimal("0.00000001")))
 
 
+def chunks(items, size=500):
+    """Splits a list into slices of at most ``size`` items, e.g. to keep
+    ``__in`` lookups below the backend's query parameter limit."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def split_amount(amount, parts):
+    """
+    Splits a bitcoin amount into ``parts`` nearly equal parts which add up
+    to exactly the amount. The leftover satoshis go one each to the first
+    parts.
+    """
+    satoshis = int(quantitize_bitcoin(amount) * 100000000)
+    base, remainder = divmod(satoshis, parts)
+    return [decimal.Decimal(base + (1 if i < remainder else 0)) / 100000000
+            for i in range(parts)]
+
+
 def fee_wallet():
     # Avoid circular imports
     from . import models
@@ -29,12 +48,21 @@ def fee_wallet():
     return mw
 
 
-def filter_doubles(outgoing_list):
-    ot_ids = []
-    ot_addresses = []
-    for ot in outgoing_list:
-        if ot.to_bitcoinaddress not in ot_addresses:
-            ot_ids.append(ot.id)
-            ot_addresses.append(ot.to_bitcoinaddress)
-    return ot_ids
+def plan_outgoing_batch(outgoing, max_outputs):
+    """
+    Picks the outgoing transactions for one sendmany from (id, address,
+    amount) rows in priority order. Payments to the same address are merged
+    into one output. Stops before the output count would exceed max_outputs.
 
+    Returns (ids, {address: float amount}).
+    """
+    ot_ids = []
+    outputs = {}
+    for ot_id, address, amount in outgoing:
+        if address not in outputs:
+            if len(outputs) >= max_outputs:
+                break
+            outputs[address] = decimal.Decimal(0)
+        outputs[address] += amount
+        ot_ids.append(ot_id)
+    return ot_ids, dict((address, decimal_float(amount)) for address, amount in outputs.items())